@@ -0,0 +1,137 @@
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Process many documents, listed in a manifest, with a pool of workers.
+
+The manifest is a JSON array with an object for each document, with its
+"input" and "output" paths (relative to the manifest) and, optionally,
+"options" to use for it on top of those anolis was run with, named as in
+the tests' .options files."""
+
+from __future__ import unicode_literals
+
+from io import BytesIO
+import multiprocessing
+import os
+import time
+import traceback
+
+from lxml import etree
+
+from anolislib import generator, registry, utils
+
+
+def preload(xref="data", processes=[], **kwargs):
+    """Load the data files the given processes use in the given directory,
+    so that workers forked afterwards all share them."""
+    for path in registry.dataFiles(processes, xref):
+        try:
+            utils.loadJSON(path)
+        except (IOError, ValueError):
+            # Processes needing anything missing or broken will say so
+            pass
+
+
+def warmUp(processes):
+    """Import the given processes, and whatever parsing and serializing a
+    document needs, so that workers forked afterwards don't all have to."""
+    for process in processes:
+        try:
+            registry.get(process).load()
+        except (utils.AnolisException, ImportError):
+            # Documents using it will fail with the error
+            pass
+    generator.toString(generator.fromFile(BytesIO(b""), processes=[]))
+
+
+def processDocument(job):
+    """Process a single document, returning the result for the summary."""
+    entry, kwargs = job
+    result = {"input": entry["input"], "output": entry["output"],
+              "error": None}
+    start = time.time()
+    try:
+        input = open(entry["input"], "rb")
+        try:
+            tree = generator.fromFile(input, **kwargs)
+        finally:
+            input.close()
+        output = open(entry["output"], "wb")
+        try:
+            generator.toFile(tree, output, **kwargs)
+        finally:
+            output.close()
+    except (utils.AnolisException, IOError, etree.XMLSyntaxError) as e:
+        result["error"] = "%s" % e
+    except Exception:
+        # Carry on with the other documents whatever goes wrong with one
+        result["error"] = traceback.format_exc().strip()
+    result["seconds"] = time.time() - start
+    return result
+
+
+def readManifest(manifest, **kwargs):
+    """Return an (entry, options) pair for each document in the manifest,
+    with absolute paths in the entry."""
+    base = os.path.dirname(os.path.abspath(manifest))
+    work = []
+    for entry in utils.loadJSON(manifest):
+        options = dict(kwargs)
+        options.update((str(key), value)
+                       for key, value in entry.get("options", {}).items())
+        entry = {"input": os.path.join(base, entry["input"]),
+                 "output": os.path.join(base, entry["output"])}
+        work.append((entry, options))
+    return work
+
+
+def run(manifest, jobs=1, **kwargs):
+    """Process every document in the manifest, using the given number of
+    worker processes, returning their results in manifest order."""
+    work = readManifest(manifest, **kwargs)
+
+    for entry, options in work:
+        preload(options.get("xref", "data"), options.get("processes", []))
+    warmUp(set(process for entry, options in work
+               for process in options.get("processes", [])))
+
+    if jobs <= 1:
+        return [processDocument(job) for job in work]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(processDocument, work, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def summary(results, seconds, output):
+    """Write a line for each document, with errors after them, and totals."""
+    failed = [result for result in results if result["error"] is not None]
+    for result in results:
+        output.write("%-6s %8.3fs  %s\n" % (
+            "FAILED" if result["error"] is not None else "ok",
+            result["seconds"], result["input"]))
+    for result in failed:
+        output.write("\n%s:\n%s\n" % (result["input"], result["error"]))
+    output.write("\n%i documents, %i failed, in %.3fs (%.3fs processing)\n"
+                 % (len(results), len(failed), seconds,
+                    sum(result["seconds"] for result in results)))
+    return not failed
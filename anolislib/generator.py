@@ -21,6 +21,8 @@
 
 from __future__ import unicode_literals
 
+import logging
+
 import html5lib
 from html5lib import treebuilders, treewalkers
 from html5lib.serializer import htmlserializer
@@ -28,31 +30,117 @@ from html5lib.serializer import htmlserializer
 import lxml.html
 from lxml import etree
 
-
-def process(tree, processes=["sub", "toc", "xref"], **kwargs):
-    """ Process the given tree. """
+from anolislib import queries, registry, timing, utils, walker
+
+log = logging.getLogger("anolis")
+# Leave it to whatever uses anolis to say where the messages go
+log.addHandler(logging.NullHandler())
+
+
+def process(tree, processes=["sub", "toc", "xref"], fuse_walks=True,
+            context=None, timings=None, **kwargs):
+    """ Process the given tree.
+
+    The processes, named as in the registry, run in the order given, as
+    registry.pipeline has it. Consecutive processes that provide a Visitor
+    share a single walk over the tree, unless fuse_walks is false; all of
+    them get the same context (a new utils.DocumentContext, by default).
+    Processes with nothing to do in the document get skipped, and
+    <!--begin-foo--> comments that no process replaces get warned about.
+    Returns a dict saying how many walks that took, how many the processes
+    would have taken on their own, how often the text content of an element
+    was reused, and which processes were skipped. Each process, and each
+    shared walk, gets timed in timings, if given, along with the queries the
+    processes made. """
+
+    if context is None:
+        context = utils.DocumentContext(tree)
+    kwargs["context"] = context
+    queries_before = queries.snapshot()
+
+    walks = {"processes": 0, "walks": 0, "classic_walks": 0, "skipped": []}
+    visitors = []
+    # Processes waiting for the walk that might add markers to the document,
+    # or change ids behind the back of the context
+    adding_markers = []
+    mutating_ids = []
+
+    def runVisitors():
+        walker.run(tree, visitors, timings=timings, **kwargs)
+        walks["walks"] += 1
+        del visitors[:]
+        if adding_markers:
+            context.invalidateMarkers()
+            del adding_markers[:]
+        if mutating_ids:
+            context.ids.invalidate()
+            del mutating_ids[:]
+
+    pipeline = registry.pipeline(processes)
+    warnUnreplaced(context)
 
     # Find number of passes to do
-    for process in processes:
-        try:
-            process_module = getattr(__import__('processes', globals(),
-                                                locals(), [str(process)], -1),
-                                    process)
-        except AttributeError:
-            process_module = __import__(process, globals(), locals(), [], -1)
-
-        getattr(process_module, process)(tree, **kwargs)
-
-
-def fromFile(input, processes=set(["sub", "toc", "xref"]), parser="html5lib",
-             profile=False, **kwargs):
+    for process in pipeline:
+        if not adding_markers and \
+           not process.needed(context.markers, **kwargs):
+            log.info("Skipped %s, as the document has nothing for it",
+                     process.name)
+            walks["skipped"].append(process.name)
+            continue
+
+        visitor = fuse_walks and process.visitor
+        if visitor:
+            # A process given twice has to see what it did the first time
+            if visitors and (visitor.barrier or visitor in visitors):
+                runVisitors()
+            visitors.append(visitor)
+            if process.adds_markers:
+                adding_markers.append(process)
+            if process.mutates_ids:
+                mutating_ids.append(process)
+            walks["processes"] += 1
+            walks["classic_walks"] += visitor.classic_walks
+        else:
+            if visitors:
+                runVisitors()
+            with timing.phase(timings, process.name):
+                process.function(tree, **kwargs)
+            if process.adds_markers:
+                context.invalidateMarkers()
+            if process.mutates_ids:
+                context.ids.invalidate()
+
+    if visitors:
+        runVisitors()
+
+    walks["text_hits"] = context.texts.hits
+    walks["text_misses"] = context.texts.misses
+    if timings is not None:
+        timings.counts.update(context.counts)
+        timings.walks.update(walks)
+        timings.queries.update(queries.since(queries_before))
+    return walks
+
+
+def warnUnreplaced(context):
+    """Warn about <!--begin-foo--> comments in the document that no process
+    replaces, such as misspelt ones."""
+    known = registry.comments()
+    for name, directives in sorted(context.markers.directives.items()):
+        if name not in known and \
+           any(not directive.lone for directive in directives):
+            log.warning("No process replaces <!--begin-%s-->", name)
+
+
+def parse(input, parser="html5lib"):
+    """Parse the given file with the named parser, returning the tree."""
     # Parse as XML:
     #if parser == "lxml.etree":
     if False:
-        tree = etree.parse(input)
+        return etree.parse(input)
     # Parse as HTML using lxml.html
     elif parser == "lxml.html":
-        tree = lxml.html.parse(input)
+        return lxml.html.parse(input)
     # Parse as HTML using html5lib
     else:
         builder = treebuilders.getTreeBuilder("lxml", etree)
@@ -60,35 +148,61 @@ def fromFile(input, processes=set(["sub", "toc", "xref"]), parser="html5lib",
             parser = html5lib.HTMLParser(tree=builder, namespaceHTMLElements=False)
         except TypeError:
             parser = html5lib.HTMLParser(tree=builder)
-        tree = parser.parse(input)
+        return parser.parse(input)
+
+
+def fromFile(input, processes=["sub", "toc", "xref"], parser="html5lib",
+             profile=False, timings=None, **kwargs):
+    # Parse, timing it if asked to
+    with timing.phase(timings, "parse"):
+        tree = parse(input, parser)
 
     # Close the input file
     input.close()
 
+    # Everything the processes find out about this document
+    context = utils.DocumentContext(tree)
+
     # Run the generator, and profile, or not, as the case may be
     if profile:
         import os
+        import sys
         import tempfile
         statfile = tempfile.mkstemp()[1]
         try:
             import cProfile
             import pstats
-            cProfile.runctx("process(tree, processes, **kwargs)", globals(),
-                            locals(), statfile)
-            stats = pstats.Stats(statfile)
+            scope = locals()
+            cProfile.runctx("walks = process(tree, processes, "
+                            "context=context, timings=timings, "
+                            "**kwargs)",
+                            globals(), scope, statfile)
+            walks = scope["walks"]
+            stats = pstats.Stats(statfile, stream=sys.stderr)
         except None:
             import hotshot
             import hotshot.stats
             prof = hotshot.Profile(statfile)
-            prof.runcall(process, tree, processes, **kwargs)
+            walks = prof.runcall(process, tree, processes, context=context,
+                                 timings=timings, **kwargs)
             prof.close()
             stats = hotshot.stats.load(statfile)
+            stats.stream = sys.stderr
         stats.strip_dirs()
         stats.sort_stats('time')
         stats.print_stats()
         os.remove(statfile)
+        # Keep all this away from the document, if that's going to stdout
+        sys.stderr.write("%(processes)i processes shared %(walks)i tree "
+                         "walks (%(classic_walks)i when run separately)\n"
+                         "Text content cache: %(text_hits)i hits, "
+                         "%(text_misses)i misses\n" % walks)
+        if walks["skipped"]:
+            sys.stderr.write("Skipped, with nothing to do: %s\n"
+                             % ", ".join(walks["skipped"]))
     else:
-        process(tree, processes, **kwargs)
+        process(tree, processes, context=context, timings=timings,
+                **kwargs)
 
     # Return the tree
     return tree
@@ -110,9 +224,10 @@ def toString(tree, output_encoding="utf-8", serializer="html5lib", **kwargs):
     return rendered
 
 def toFile(tree, output, output_encoding="utf-8", serializer="html5lib",
-           **kwargs):
-    rendered = toString(tree, output_encoding=output_encoding,
-                        serializer=serializer, **kwargs)
+           timings=None, **kwargs):
+    with timing.phase(timings, "serialize"):
+        rendered = toString(tree, output_encoding=output_encoding,
+                            serializer=serializer, **kwargs)
 
     # Write to the output
     output.write(rendered)
@@ -24,6 +24,8 @@ from __future__ import unicode_literals
 from lxml import etree
 from collections import defaultdict
 
+from anolislib import queries, walker
+
 import sys
 if sys.version_info[0] == 3:
     from urllib.parse import urlsplit
@@ -32,6 +34,10 @@ else:
     from urlparse import urlsplit
     from urllib2 import urlopen
 
+entries = queries.xpath("//entry")
+entries_with_issues = queries.xpath("//entry[issue]")
+entry_issues = queries.xpath("./issue")
+
 statuses =   {"UNKNOWN": "Unknown",
               "TBW": "Idea; yet to be specified",
               "WIP": "Being edited right now",
@@ -58,9 +64,44 @@ w3c_status_names = {"WD":"Working Draft",
                     "REC":"W3C Recommendation"}
 
 
+heading_elements = frozenset(["h1", "h2", "h3", "h4", "h5", "h6"])
+
+
 def annotate(ElementTree, **kwargs):
-    if not "annotation" in kwargs or not kwargs["annotation"]:
+    annotations = load_annotations(**kwargs)
+    if annotations is None:
         return
+
+    for element in ElementTree.getroot().iterdescendants():
+        annotate_element(element, *annotations,
+                         context=kwargs.get("context"))
+
+
+class Visitor(walker.Visitor):
+    """Add annotations to the headings found in a shared tree walk."""
+
+    def __init__(self, ElementTree, **kwargs):
+        walker.Visitor.__init__(self, ElementTree)
+        self.annotations = load_annotations(**kwargs)
+        self.headings = []
+
+    def register(self, walk):
+        if self.annotations is not None:
+            walk.register(start=self.collect)
+
+    def collect(self, element):
+        if element.tag in heading_elements:
+            self.headings.append(element)
+
+    def finish(self, context=None, **kwargs):
+        for heading in self.headings:
+            annotate_element(heading, *self.annotations,
+                             context=context)
+
+
+def load_annotations(**kwargs):
+    if not "annotation" in kwargs or not kwargs["annotation"]:
+        return None
     else:
         annotation_location = kwargs["annotation"]
 
@@ -76,7 +117,7 @@ def annotate(ElementTree, **kwargs):
     
     statuses = {}
     if add_whatwg_status:
-        for entry in annotations.xpath("//entry"):
+        for entry in entries(annotations):
             statuses[entry.attrib["section"]] = entry
 
     add_w3c_issues = ("annotate_w3c_issues" in kwargs and 
@@ -88,20 +129,25 @@ def annotate(ElementTree, **kwargs):
         spec_status = annotations.getroot().attrib["status"]
         assert spec_status in w3c_statuses
 
-        for entry in annotations.xpath("//entry[issue]"):
-            for issue in entry.xpath("./issue"):
+        for entry in entries_with_issues(annotations):
+            for issue in entry_issues(entry):
                 issues[entry.attrib["section"]].append(issue)
 
-    heading_elements = set(["h1", "h2", "h3", "h4", "h5", "h6"])
-    for element in ElementTree.getroot().iterdescendants():
-        if ("id" in element.attrib and 
-            (element.attrib["id"] in statuses or
-             element.attrib["id"] in issues) and           
-            element.tag in heading_elements):    
-            status = statuses.get(element.attrib["id"], None)
-            issue_list = issues.get(element.attrib["id"], None)
-            annotation = make_annotation(status, issue_list, spec_status)
-            element.addnext(annotation)
+    return statuses, issues, spec_status
+
+
+def annotate_element(element, statuses, issues, spec_status,
+                     context=None):
+    if ("id" in element.attrib and 
+        (element.attrib["id"] in statuses or
+         element.attrib["id"] in issues) and           
+        element.tag in heading_elements):    
+        status = statuses.get(element.attrib["id"], None)
+        issue_list = issues.get(element.attrib["id"], None)
+        annotation = make_annotation(status, issue_list, spec_status)
+        if context is not None:
+            context.texts.invalidate(element.getparent())
+        element.addnext(annotation)
 
 def make_annotation(entry, issues, spec_status):
 
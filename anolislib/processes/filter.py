@@ -19,15 +19,20 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from lxml import cssselect
+from anolislib import queries
 
 def filter(ElementTree, **kwargs):
     if not "filter" in kwargs or kwargs["filter"] == None:
         return
-    selector = cssselect.CSSSelector(kwargs["filter"])
+    context = kwargs.get("context")
+    selector = queries.selector(kwargs["filter"])
     for element in selector(ElementTree.getroot()):
         previous = element.getprevious()
         parent = element.getparent()
+        if context is not None:
+            context.texts.invalidate(parent)
+            context.ids.discard(element)
+            context.invalidateOutline(element)
         if element.tail != None:
             if previous != None:
                 if previous.tail != None:
@@ -26,12 +26,18 @@ class lof(object):
   """Add a List of Figures."""
 
   def __init__(self, ElementTree, **kwargs):
+    # Share one context between everything done to the document, when not
+    # run by the generator
+    if kwargs.get("context") is None:
+      kwargs["context"] = utils.DocumentContext(ElementTree)
     #self.figures = []
     self.tables = []
-    self.readDoc(ElementTree, u"Table", u"table", u"caption", self.tables)
-    self.addList(ElementTree, self.tables, u"tables")
+    self.readDoc(ElementTree, u"Table", u"table", u"caption", self.tables,
+                 **kwargs)
+    self.addList(ElementTree, self.tables, u"tables", **kwargs)
 
-  def readDoc(self, ElementTree, name, localName, captionLocalName, figures):
+  def readDoc(self, ElementTree, name, localName, captionLocalName, figures,
+              context=None, **kwargs):
     i = 0
     for element in ElementTree.getroot().findall(u".//%s" % localName):
       i += 1
@@ -39,7 +45,8 @@ class lof(object):
         continue
 
       if not u"id" in element.attrib:
-        element.set(u"id", u"anolis-%s-%d" % (localName, i))
+        utils.setID(element, u"anolis-%s-%d" % (localName, i),
+                    context=context)
       id = element.get(u"id")
 
       cap = element.find(u".//%s" % captionLocalName)
@@ -48,15 +55,19 @@ class lof(object):
         cap.text = u"(untitled)"
         element.append(cap)
 
-      caption = utils.textContent(cap)
+      caption = utils.textContent(cap, context=context)
+      if context is not None:
+        context.texts.invalidate(cap)
       cap.text = u"%s %d: %s" % (name, i, cap.text)
 
       figures.append((id, caption))
 
-  def addList(self, ElementTree, figures, id):
+  def addList(self, ElementTree, figures, id, context=None, **kwargs):
     root = ElementTree.getroot().find(u".//div[@id='anolis-listof%s']" % id)
     if root is None:
       raise SyntaxError, u"A <div id=anolis-listof%s> is required." % id
+    if context is not None:
+      context.texts.invalidate(root)
     ol = etree.Element(u"ol")
     root.append(ol)
     for figure in figures:
@@ -28,11 +28,40 @@ from anolislib import utils
 # Rank of heading elements (these are negative so h1 > h6)
 fixedRank = {"h1": -1, "h2": -2, "h3": -3, "h4": -4, "h5": -5, "h6": -6}
 
+# The headings that give an hgroup its rank; h6 has never been looked for,
+# leaving an hgroup with only h6 elements with the rank of an h1
+hgroupRanked = ("h1", "h2", "h3", "h4", "h5")
+
+
+# What the outline algorithm does with each element depends only on which of
+# these it is in, and nothing at all happens for any other element
+HEADING, SECTIONING_CONTENT, SECTIONING_ROOT = range(3)
+categories = dict([(tag, HEADING) for tag in utils.heading_content] +
+                  [(tag, SECTIONING_CONTENT)
+                   for tag in utils.sectioning_content] +
+                  [(tag, SECTIONING_ROOT) for tag in utils.sectioning_root])
+
+
+def getOutline(ElementTree, context=None, **kwargs):
+    """Return the outline of the document, built once and shared through the
+    context, if there is one, until something invalidates it."""
+    if context is None:
+        return Outliner(ElementTree, **kwargs).build(**kwargs)
+    if context.outline is None:
+        context.outline = Outliner(ElementTree, **kwargs).build(**kwargs)
+    return context.outline
+
 
 class section(list):
     """Represents the section of a document."""
 
-    header = None
+    # Sections get built by the thousand for big documents, so don't give
+    # each a __dict__; parent is only set on sections appended to another
+    __slots__ = ("header", "parent")
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.header = None
 
     def __repr__(self):
         return "<section %s>" % (repr(self.header))
@@ -56,6 +85,8 @@ class Outliner:
         self.outlines = {}
         self.current_outlinee = None
         self.current_section = None
+        # Rank of each heading entered, worked out once on entering it
+        self.ranks = {}
     
     def _rank(self, element):
         if element.tag in fixedRank:
@@ -65,107 +96,124 @@ class Outliner:
         # elements, or otherwise the same as for an h1 element (the highest
         # rank).
         elif element.tag == "hgroup":
-            for i in range(1, 6):
-                if element.find(".//h%i" % i) is not None:
-                    return -i
-            else:
-                return -1
+            rank = None
+            for descendant in element.iter(*hgroupRanked):
+                if rank is None or fixedRank[descendant.tag] > rank:
+                    rank = fixedRank[descendant.tag]
+                    if rank == -1:
+                        break
+            return rank if rank is not None else -1
         else:
             raise ValueError("Only h1–h6 and hgroup elements have a rank")
 
+    def _headerRank(self, header):
+        # Section headings have all been entered, and so ranked, already
+        return self.ranks.get(header) or self._rank(header)
+
     def build(self, **kwargs):
-        for action, element in etree.iterwalk(self.ElementTree,
-                                              events=("start", "end")):
+        stack = self.stack
+        outlines = self.outlines
+        current_outlinee = self.current_outlinee
+        current_section = self.current_section
+
+        walk = etree.iterwalk(self.ElementTree, events=("start", "end"))
+        # Headings' descendants can only be skipped with lxml 4.6 and later;
+        # before that, they get walked through and ignored
+        skip_subtree = getattr(walk, "skip_subtree", None)
+
+        for action, element in walk:
             # If the top of the stack is an element, and you are exiting that
             # element
-            if action == "end" and self.stack and self.stack[-1] == element:
+            if action == "end" and stack and stack[-1] is element:
                 # Note: The element being exited is a heading content element.
                 assert element.tag in utils.heading_content
                 # Pop that element from the stack.
-                self.stack.pop()
+                stack.pop()
+                continue
 
             # If the top of the stack is a heading content element
-            elif self.stack and self.stack[-1].tag in utils.heading_content:
+            if skip_subtree is None and stack and \
+               stack[-1].tag in utils.heading_content:
                 # Do nothing.
-                pass
+                continue
+
+            category = categories.get(element.tag)
+            if category is None:
+                # Do nothing.
+                continue
 
             # When entering a sectioning content element or a sectioning root
             # element
-            elif action == "start" and \
-                 (element.tag in utils.sectioning_content or \
-                  element.tag in utils.sectioning_root):
+            if action == "start" and category != HEADING:
                 # If current outlinee is not null, push current outlinee onto
                 # the stack.
-                if self.current_outlinee is not None:
-                    self.stack.append(self.current_outlinee)
+                if current_outlinee is not None:
+                    stack.append(current_outlinee)
                 # Let current outlinee be the element that is being entered.
-                self.current_outlinee = element
+                current_outlinee = element
                 # Let current section be a newly created section for the
                 # current outlinee element.
-                self.current_section = section()
+                current_section = section()
                 # Let there be a new outline for the new current outlinee,
                 # initialized with just the new current section as the only
                 # section in the outline.
-                self.outlines[self.current_outlinee] = [self.current_section]
+                outlines[current_outlinee] = [current_section]
 
             # When exiting a sectioning content element, if the stack is not
             # empty
-            elif action == "end" and \
-                 element.tag in utils.sectioning_content and self.stack:
+            elif action == "end" and category == SECTIONING_CONTENT and stack:
                 # Pop the top element from the stack, and let the current
                 # outlinee be that element.
-                self.current_outlinee = self.stack.pop()
+                current_outlinee = stack.pop()
                 # Let current section be the last section in the outline of the
                 # current outlinee element.
-                self.current_section = self.outlines[self.current_outlinee][-1]
+                current_section = outlines[current_outlinee][-1]
                 # Append the outline of the sectioning content element being
                 # exited to the current section. (This does not change which
                 # section is the last section in the outline.)
-                self.current_section += self.outlines[element]
+                current_section += outlines[element]
 
             # When exiting a sectioning root element, if the stack is not empty
-            elif action == "end" and element.tag in utils.sectioning_root and \
-                 self.stack:
+            elif action == "end" and category == SECTIONING_ROOT and stack:
                 # Pop the top element from the stack, and let the current
                 # outlinee be that element.
-                self.current_outlinee = self.stack.pop()
+                current_outlinee = stack.pop()
                 # Let current section be the last section in the outline of the
                 # current outlinee element.
-                self.current_section = self.outlines[self.current_outlinee][-1]
+                current_section = outlines[current_outlinee][-1]
                 # Loop: If current section has no child sections, stop these
                 # steps.
-                while self.current_section:
+                while current_section:
                     # Let current section be the last child section of the
                     # current current section.
-                    assert self.current_section != self.current_section[-1]
-                    self.current_section = self.current_section[-1]
+                    assert current_section != current_section[-1]
+                    current_section = current_section[-1]
                     # Go back to the substep labeled Loop.
 
             # When exiting a sectioning content element or a sectioning root
             # element
-            elif action == "end" and \
-                 (element.tag in utils.sectioning_content or \
-                  element.tag in utils.sectioning_root):
+            elif action == "end" and category != HEADING:
                 # Note: The current outlinee is the element being exited.
-                assert self.current_outlinee == element
+                assert current_outlinee == element
                 # Let current section be the first section in the outline of
                 # the current outlinee element.
-                self.current_section = self.outlines[self.current_outlinee][0]
+                current_section = outlines[current_outlinee][0]
                 # Skip to the next step in the overall set of steps. (The walk
                 # is over.)
                 break
 
             # If the current outlinee is null.
-            elif self.current_outlinee is None:
+            elif current_outlinee is None:
                 # Do nothing.
                 pass
 
             # When entering a heading content element
-            elif action == "start" and element.tag in utils.heading_content:
+            elif action == "start":
+                rank = self.ranks[element] = self._rank(element)
                 # If the current section has no heading, let the element being
                 # entered be the heading for the current section.
-                if self.current_section.header is None:
-                    self.current_section.header = element
+                if current_section.header is None:
+                    current_section.header = element
 
                 # Otherwise, if the element being entered has a rank equal to
                 # or greater than the heading of the last section of the
@@ -175,17 +223,16 @@ class Outliner:
                 # outline. Let current section be that new section. Let the
                 # element being entered be the new heading for the current
                 # section.
-                elif self._rank(element) >= \
-                     self._rank(self.outlines[self.current_outlinee][-1].header):
-                    self.current_section = section()
-                    self.outlines[self.current_outlinee] \
-                        .append(self.current_section)
-                    self.current_section.header = element
+                elif rank >= self._headerRank(
+                        outlines[current_outlinee][-1].header):
+                    current_section = section()
+                    outlines[current_outlinee].append(current_section)
+                    current_section.header = element
 
                 # Otherwise, run these substeps:
                 else:
                     # Let candidate section be current section.
-                    candidate_section = self.current_section
+                    candidate_section = current_section
                     while True:
                         # If the element being entered has a rank lower than
                         # the rank of the heading of the candidate section,
@@ -195,11 +242,10 @@ class Outliner:
                         # this new section. Let the element being entered be
                         # the new heading for the current section. Abort these
                         # substeps.
-                        if self._rank(element) < \
-                           self._rank(candidate_section.header):
-                            self.current_section = section()
-                            candidate_section.append(self.current_section)
-                            self.current_section.header = element
+                        if rank < self._headerRank(candidate_section.header):
+                            current_section = section()
+                            candidate_section.append(current_section)
+                            current_section.header = element
                             break
                         # Let new candidate section be the section that
                         # contains candidate section in the outline of current
@@ -209,11 +255,16 @@ class Outliner:
                         # Return to step 2.
                 # Push the element being entered onto the stack. (This causes
                 # the algorithm to skip any descendants of the element.)
-                self.stack.append(element)
+                stack.append(element)
+                if skip_subtree is not None:
+                    skip_subtree()
+
+        self.current_outlinee = current_outlinee
+        self.current_section = current_section
 
         # If the current outlinee is null, then there was no sectioning content
         # element or sectioning root element in the DOM. There is no outline.
         try:
-            return self.outlines[self.current_outlinee]
+            return outlines[current_outlinee]
         except KeyError:
             return None
@@ -32,6 +32,10 @@ class refs(object):
   """Add references section."""
 
   def __init__(self, ElementTree, split_references_section=False, dump_refs='', **kwargs):
+    # Share one context between everything done to the document, when not
+    # run by the generator
+    if kwargs.get("context") is None:
+      kwargs["context"] = utils.DocumentContext(ElementTree)
     self.refs = {}
     self.usedrefs = []
     self.foundrefs = {}
@@ -55,9 +59,7 @@ class refs(object):
       dl.append(self.createReference(r, informative))
 
   def buildReferences(self, ElementTree, xref="data", **kwargs):
-    list = open(xref + "/references.json", "r")
-    self.refs = json.load(list)
-    list.close()
+    self.refs = utils.loadJSON(xref + "/references.json")
 
   def getTwoReferencesLists(self):
     informative = []
@@ -80,37 +82,45 @@ class refs(object):
     self.addPartialReferencesList(ElementTree, refs["normative"], "normative", **kwargs)
     self.addPartialReferencesList(ElementTree, refs["informative"], "informative", **kwargs)
 
-  def addPartialReferencesList(self, ElementTree, l, id, **kwargs):
+  def addPartialReferencesList(self, ElementTree, l, id, context=None, **kwargs):
     if not len(l):
       return
     root = ElementTree.getroot().find(".//div[@id='anolis-references-%s']" % id)
     if root is None:
       raise SyntaxError("A <div id=anolis-references-%s> is required." % id)
+    if context is not None:
+      context.texts.invalidate(root)
     dl = etree.Element("dl")
     root.append(dl)
     for ref in l:
       if not ref in self.refs:
         raise SyntaxError("Reference not defined: %s." % ref)
       dt = etree.Element("dt")
-      dt.set("id", "refs" + ref)
+      utils.setID(dt, "refs" + ref, context=context)
       dt.text = "[" + ref + "]\n"
       dl.append(dt)
       self.addDD(dl, ref, False)
+    if context is not None:
+      context.count("references", len(l))
 
-  def addReferencesList(self, ElementTree, **kwargs):
+  def addReferencesList(self, ElementTree, context=None, **kwargs):
     root = ElementTree.getroot().find(".//div[@id='anolis-references']")
     if root is None:
       raise SyntaxError("A <div id=anolis-references> is required.")
+    if context is not None:
+      context.texts.invalidate(root)
     dl = etree.Element("dl")
     root.append(dl)
     for ref in self.usedrefs:
       if not ref in self.refs:
         raise SyntaxError("Reference not defined: %s." % ref)
       dt = etree.Element("dt")
-      dt.set("id", "refs" + ref)
+      utils.setID(dt, "refs" + ref, context=context)
       dt.text = "[" + ref + "]\n"
       dl.append(dt)
       self.addDD(dl, ref, not ref in self.normativerefs)
+    if context is not None:
+      context.count("references", len(self.usedrefs))
 
   def createReference(self, ref, informative):
     cite = etree.Element("cite")
@@ -149,11 +159,12 @@ class refs(object):
       return "%s, %s, %s et al." % tuple(authors[:3])
     if len(authors) == 1:
       return "%s" % (authors[0], )
-    last = authors.pop()
-    return "%s and %s" % (", ".join(authors), last)
+    return "%s and %s" % (", ".join(authors[:-1]), authors[-1])
 
-  def addReferencesLinks(self, ElementTree, **kwargs):
+  def addReferencesLinks(self, ElementTree, context=None, **kwargs):
     for element in ElementTree.getroot().findall(".//span[@data-anolis-ref]"):
+      if context is not None:
+        context.texts.invalidate(element)
       del element.attrib["data-anolis-ref"]
       ref = element.text
       element.tag = "a"
@@ -34,10 +34,10 @@ class replaceHeadings(object):
     def __init__(self, ElementTree, **kwargs):
         self.replaceHeadings(ElementTree, **kwargs)
 
-    def replaceHeadings(self, ElementTree, **kwargs):
+    def replaceHeadings(self, ElementTree, context=None, **kwargs):
         # Build the outline of the document
-        outline_creator = outliner.Outliner(ElementTree, **kwargs)
-        outline = outline_creator.build(**kwargs)
+        outline = outliner.getOutline(ElementTree, context=context, **kwargs)
+        renamed = False
 
         # Get a list of all the top level sections, and their depth (1)
         sections = [(section, 1) for section in reversed(outline)]
@@ -51,7 +51,9 @@ class replaceHeadings(object):
             if section.header is not None and section.header.tag in \
                                               numered_headings:
                 if depth <= 6:
-                    section.header.tag = "h%i" % depth
+                    if section.header.tag != "h%i" % depth:
+                        section.header.tag = "h%i" % depth
+                        renamed = True
                 else:
                     raise TooDeepException("Too deep for numbered headers")
             
@@ -60,6 +62,10 @@ class replaceHeadings(object):
             sections.extend([(child_section, depth + 1)
                              for child_section in reversed(section)])
 
+        # Heading ranks have changed, so the outline may have too
+        if renamed and context is not None:
+            context.invalidateOutline()
+
 
 class TooDeepException(utils.AnolisException):
     """That's real deep. But we only have six levels of numbered headers."""
@@ -28,7 +28,7 @@ import os
 from lxml import etree
 from copy import deepcopy
 
-from anolislib import utils
+from anolislib import queries, utils, walker
 
 latest_version = re.compile("latest[%s]+version" % utils.spaceCharacters,
                             re.IGNORECASE)
@@ -36,14 +36,9 @@ latest_version = re.compile("latest[%s]+version" % utils.spaceCharacters,
 w3c_tr_url_status = r"http://www\.w3\.org/TR/[^/]*/(MO|WD|CR|PR|REC|PER|NOTE)-"
 w3c_tr_url_status = re.compile(w3c_tr_url_status)
 
-title = re.compile(r"\[TITLE[^\]]*\]")
-title_identifier = "[TITLE"
+# The text nodes getW3CStatus looks for the status in
+status_texts = queries.xpath("//text()[contains(translate(., 'LATEST', 'latest'), 'latest') and contains(translate(., 'VERSION', 'version'), 'version') or contains(., 'http://www.w3.org/TR/')]")
 
-status = re.compile(r"\[STATUS[^\]]*\]")
-status_identifier = "[STATUS"
-
-longstatus = re.compile(r"\[LONGSTATUS[^\]]*\]")
-longstatus_identifier = "[LONGSTATUS"
 longstatus_map = {
     "MO": "W3C Member-only Draft",
     "ED": "Editor's Draft",
@@ -55,20 +50,89 @@ longstatus_map = {
     "NOTE": "W3C Working Group Note"
 }
 
-shortname = re.compile(r"\[SHORTNAME[^\]]*\]")
-shortname_identifier = "[SHORTNAME"
-
-latest = re.compile(r"\[LATEST[^\]]*\]")
-latest_identifier = "[LATEST"
+# The [NAME...] placeholders stringSubstitutions replaces, in the order they
+# are substituted in
+placeholders = ("YEAR", "DATE", "CDATE", "UDATE", "TITLE", "STATUS",
+                "LONGSTATUS", "SHORTNAME", "LATEST", "VERSION")
+placeholder = r"\[(%s)[^\]]*\]" % "|".join(placeholders)
+placeholder_identifier = "["
 
-version = re.compile(r"\[VERSION[^\]]*\]")
-version_identifier = "[VERSION"
+# A placeholder with another [ before its ], as in [DATE [YEAR]], whose end
+# depends on what gets substituted inside it first
+nested_placeholder = re.compile(r"\[(%s)[^\]]*\[" % "|".join(placeholders))
 
-w3c_stylesheet = re.compile(r"http://www\.w3\.org/StyleSheets/TR/W3C-[A-Z]+")
+w3c_stylesheet = r"http://www\.w3\.org/StyleSheets/TR/W3C-[A-Z]+"
 w3c_stylesheet_identifier = "http://www.w3.org/StyleSheets/TR/W3C-"
 
+# Every placeholder, and optionally the stylesheet URL too, in one pattern
+placeholder_matcher = re.compile(placeholder)
+placeholder_and_stylesheet_matcher = re.compile("%s|%s" % (placeholder,
+                                                           w3c_stylesheet))
+
+# Each placeholder on its own, for substituting them one kind at a time
+placeholder_matchers = dict((name, re.compile(r"\[%s[^\]]*\]" % name))
+                            for name in placeholders)
+w3c_stylesheet_matcher = re.compile(w3c_stylesheet)
+
 basic_comment_subs = ()
 
+# The comments commentSubstitutions does anything with, the latter only in
+# compat. mode
+link_comments = frozenset(["begin-link"])
+compat_comments = frozenset(["logo", "begin-logo", "copyright",
+                             "begin-copyright"])
+
+
+class StringSubstitutions(object):
+    """Replace the placeholders in a string, given as a dict from their names
+    to what to replace them with, in a single scan of it. Placeholders left
+    out of the dict are left alone. The stylesheet URL, if given, replaces
+    any W3C stylesheet URL."""
+
+    def __init__(self, replacements, stylesheet=None):
+        self.original_replacements = replacements
+        self.stylesheet = stylesheet
+        if stylesheet is None:
+            self.matcher = placeholder_matcher
+        else:
+            self.matcher = placeholder_and_stylesheet_matcher
+        # What a placeholder is replaced by can itself contain placeholders
+        # coming after it (say, [STATUS] in the title), and those are
+        # replaced as well, as if substituting each kind in turn
+        self.replacements = {}
+        for name in reversed(placeholders):
+            if name in replacements:
+                self.replacements[name] = self.replace(replacements[name])
+
+    def replacement(self, match):
+        name = match.group(1)
+        if name is None:
+            return self.stylesheet
+        return self.replacements.get(name, match.group(0))
+
+    def replace(self, string):
+        if placeholder_identifier in string and \
+           nested_placeholder.search(string):
+            return self.replaceInTurn(string)
+        if placeholder_identifier in string or \
+           self.stylesheet is not None and \
+           w3c_stylesheet_identifier in string:
+            return self.matcher.sub(self.replacement, string)
+        return string
+
+    def replaceInTurn(self, string):
+        """Replace each kind of placeholder in turn, then the stylesheet URL,
+        each in what replacing the ones before gave."""
+        for name in placeholders:
+            if name in self.original_replacements:
+                replacement = self.original_replacements[name]
+                string = placeholder_matchers[name].sub(
+                    lambda match: replacement, string)
+        if self.stylesheet is not None:
+            string = w3c_stylesheet_matcher.sub(lambda match: self.stylesheet,
+                                                string)
+        return string
+
 
 class sub(object):
     """Perform substitutions."""
@@ -80,6 +144,24 @@ class sub(object):
                  publication_date='',
                  localtime=False,
                  **kwargs):
+        self.setUp(ElementTree, w3c_compat, w3c_compat_substitutions,
+                   w3c_compat_crazy_substitutions, w3c_status,
+                   publication_date, localtime, **kwargs)
+
+        self.stringSubstitutions(ElementTree, w3c_compat,
+                                 w3c_compat_substitutions,
+                                 w3c_compat_crazy_substitutions, **kwargs)
+        self.commentSubstitutions(ElementTree, w3c_compat,
+                                  w3c_compat_substitutions,
+                                  w3c_compat_crazy_substitutions, **kwargs)
+
+    def setUp(self, ElementTree, w3c_compat=False,
+              w3c_compat_substitutions=False,
+              w3c_compat_crazy_substitutions=False,
+              w3c_status='',
+              publication_date='',
+              localtime=False,
+              **kwargs):
         if w3c_status:
             self.w3c_status = w3c_status
         elif w3c_compat or w3c_compat_substitutions or \
@@ -90,56 +172,41 @@ class sub(object):
 
         self.pubdate = publication_date and time.strptime(publication_date, "%d %b %Y") or localtime and time.localtime() or time.gmtime()
 
-        self.stringSubstitutions(ElementTree, w3c_compat,
-                                 w3c_compat_substitutions,
-                                 w3c_compat_crazy_substitutions, **kwargs)
-        self.commentSubstitutions(ElementTree, w3c_compat,
-                                  w3c_compat_substitutions,
-                                  w3c_compat_crazy_substitutions, **kwargs)
-
     def stringSubstitutions(self, ElementTree, w3c_compat=False,
                             w3c_compat_substitutions=False,
                             w3c_compat_crazy_substitutions=False,
-                            w3c_shortname='',
+                            context=None,
                             **kwargs):
+        string_subs = self.getStringSubstitutions(ElementTree, w3c_compat,
+                                                  w3c_compat_substitutions,
+                                                  w3c_compat_crazy_substitutions,
+                                                  context=context,
+                                                  **kwargs)
+        for node in ElementTree.iter():
+            self.substituteNode(node, string_subs, context)
+
+    def getStringSubstitutions(self, ElementTree, w3c_compat=False,
+                               w3c_compat_substitutions=False,
+                               w3c_compat_crazy_substitutions=False,
+                               w3c_shortname='',
+                               **kwargs):
         # Get doc_title from the title element
         try:
             doc_title = utils.textContent(ElementTree.getroot().find("head")
-                                                               .find("title"))
+                                                               .find("title"),
+                                          **kwargs)
         except (AttributeError, TypeError):
             doc_title = ""
 
-        year = re.compile(r"\[YEAR[^\]]*\]")
         year_sub = time.strftime("%Y", self.pubdate)
-        year_identifier = "[YEAR"
-
-        date = re.compile(r"\[DATE[^\]]*\]")
-        date_sub = time.strftime("%d %B %Y", self.pubdate).lstrip("0")
-        date_identifier = "[DATE"
-
-        cdate = re.compile(r"\[CDATE[^\]]*\]")
         cdate_sub = time.strftime("%Y%m%d", self.pubdate)
-        cdate_identifier = "[CDATE"
-
-        udate = re.compile(r"\[UDATE[^\]]*\]")
-        udate_sub = time.strftime("%Y-%m-%d", self.pubdate)
-        udate_identifier = "[UDATE"
-
-        string_subs = ((year, year_sub, year_identifier),
-                       (date, date_sub, date_identifier),
-                       (cdate, cdate_sub, cdate_identifier),
-                       (udate, udate_sub, udate_identifier))
-
-        if w3c_compat or w3c_compat_substitutions:
-            # Get the right long status
-            doc_longstatus = longstatus_map[self.w3c_status]
-
-        if w3c_compat_crazy_substitutions:
-            # Get the right stylesheet
-            doc_w3c_stylesheet = "http://www.w3.org/StyleSheets/TR/W3C-%s" % (self.w3c_status, )
-
-        # Get all the subs we want
-        string_subs += ((title, doc_title, title_identifier), )
+        replacements = {
+            "YEAR": year_sub,
+            "DATE": time.strftime("%d %B %Y", self.pubdate).lstrip("0"),
+            "CDATE": cdate_sub,
+            "UDATE": time.strftime("%Y-%m-%d", self.pubdate),
+            "TITLE": doc_title
+        }
 
         # And even more in compat. mode
         if w3c_compat or w3c_compat_substitutions:
@@ -147,32 +214,49 @@ class sub(object):
                 shortname_sub = w3c_shortname or os.path.basename(os.getcwd())
             except OSError:
                 shortname_sub = ""
-            latest_sub = "http://www.w3.org/TR/%s/" % (shortname_sub, )
-            version_sub = "http://www.w3.org/TR/%s/%s-%s-%s/" % (year_sub, self.w3c_status, shortname_sub, cdate_sub)
-            string_subs += ((status, self.w3c_status, status_identifier),
-                            (longstatus, doc_longstatus, longstatus_identifier),
-                            (shortname, shortname_sub, shortname_identifier),
-                            (latest, latest_sub, latest_identifier),
-                            (version, version_sub, version_identifier))
+            replacements.update({
+                "STATUS": self.w3c_status,
+                "LONGSTATUS": longstatus_map[self.w3c_status],
+                "SHORTNAME": shortname_sub,
+                "LATEST": "http://www.w3.org/TR/%s/" % (shortname_sub, ),
+                "VERSION": "http://www.w3.org/TR/%s/%s-%s-%s/" % (year_sub, self.w3c_status, shortname_sub, cdate_sub)
+            })
 
         # And more that aren't even enabled by default in compat. mode
+        doc_w3c_stylesheet = None
         if w3c_compat_crazy_substitutions:
-            string_subs += ((w3c_stylesheet, doc_w3c_stylesheet, w3c_stylesheet_identifier), )
+            # Get the right stylesheet
+            doc_w3c_stylesheet = "http://www.w3.org/StyleSheets/TR/W3C-%s" % (self.w3c_status, )
 
-        for node in ElementTree.iter():
-            for regex, sub, identifier in string_subs:
-                if node.text is not None and identifier in node.text:
-                    node.text = regex.sub(sub, node.text)
-                if node.tail is not None and identifier in node.tail:
-                    node.tail = regex.sub(sub, node.tail)
-                for name, value in node.attrib.items():
-                    if identifier in value:
-                        node.attrib[name] = regex.sub(sub, value)
+        return StringSubstitutions(replacements, doc_w3c_stylesheet)
+
+    def substituteNode(self, node, string_subs, context=None):
+        changed = False
+        text = node.text
+        if text is not None:
+            replaced = string_subs.replace(text)
+            if replaced != text:
+                node.text = replaced
+                changed = True
+        tail = node.tail
+        if tail is not None:
+            replaced = string_subs.replace(tail)
+            if replaced != tail:
+                node.tail = replaced
+                changed = True
+        for name, value in node.attrib.items():
+            replaced = string_subs.replace(value)
+            if replaced != value:
+                node.attrib[name] = replaced
+                changed = True
+        if changed and context is not None:
+            context.texts.invalidate(node)
 
     def commentSubstitutions(self, ElementTree, w3c_compat=False,
                              w3c_compat_substitutions=False,
                              w3c_compat_crazy_substitutions=False,
                              enable_woolly=False,
+                             context=None,
                              **kwargs):
         # Basic substitutions
         instance_basic_comment_subs = basic_comment_subs
@@ -193,45 +277,51 @@ class sub(object):
                                             (copyright, copyright_sub))
 
         # Set of nodes to remove
-        to_remove = set()
+        to_remove = []
 
         # Link
-        link_parent = None
-        link = None
-        for node in ElementTree.iter():
-            if link_parent is not None:
-                if node.tag is etree.Comment and \
-                   node.text.strip(utils.spaceCharacters) == "end-link":
-                    if node.getparent() is not link_parent:
-                        raise utils.DifferentParentException("begin-link and end-link have different parents")
-                    utils.removeInteractiveContentChildren(link)
-                    link.set("href", utils.textContent(link))
-                    link_parent = None
-                else:
-                    if node.getparent() is link_parent:
-                        link.append(deepcopy(node))
-                    to_remove.add(node)
-            elif node.tag is etree.Comment and \
-                 node.text.strip(utils.spaceCharacters) == "begin-link":
-                link_parent = node.getparent()
-                link = etree.Element("a")
-                link.text = node.tail
-                node.tail = None
-                node.addnext(link)
+        for directive in utils.getDirectives(ElementTree, "link", context):
+            if directive.lone:
+                continue
+            node = directive.begin
+            link_parent = node.getparent()
+            if context is not None:
+                context.texts.invalidate(link_parent)
+            link = etree.Element("a")
+            link.text = node.tail
+            node.tail = None
+            for child in directive.region():
+                if child.getparent() is link_parent:
+                    link.append(deepcopy(child))
+                to_remove.append(child)
+            node.addnext(link)
+            if directive.end is not None:
+                utils.removeInteractiveContentChildren(
+                    link, context=context)
+                link.set("href", utils.textContent(link))
+                if context is not None:
+                    context.ids.add(link)
+            # Any comments in the link are new to the MarkerScan
+            if context is not None:
+                context.invalidateMarkers()
 
         # Basic substitutions
         for comment, sub in instance_basic_comment_subs:
-            utils.replaceComment(ElementTree, comment, sub, **kwargs)
+            utils.replaceComment(ElementTree, comment, sub,
+                                 context=context, **kwargs)
 
         # Remove nodes
         for node in to_remove:
+            if context is not None:
+                context.ids.discard(node)
+                context.invalidateOutline(node)
             node.getparent().remove(node)
 
     def getW3CStatus(self, ElementTree, **kwargs):
         # Get all text nodes that contain case-insensitively "latest version"
         # with any amount of whitespace inside the phrase, or contain
         # http://www.w3.org/TR/
-        for text in ElementTree.xpath("//text()[contains(translate(., 'LATEST', 'latest'), 'latest') and contains(translate(., 'VERSION', 'version'), 'version') or contains(., 'http://www.w3.org/TR/')]"):
+        for text in status_texts(ElementTree):
             if latest_version.search(text):
                 return "ED"
             elif w3c_tr_url_status.search(text):
@@ -240,6 +330,48 @@ class sub(object):
         else:
             return "ED"
 
+class Visitor(sub, walker.Visitor):
+    """Perform substitutions as part of a shared tree walk."""
+
+    # Substituting changes text as the walk goes, which the finish() of the
+    # processes before this one must not see, and which has to happen to
+    # whatever they add
+    barrier = True
+    classic_walks = 2
+
+    def __init__(self, ElementTree, w3c_compat=False,
+                 w3c_compat_substitutions=False,
+                 w3c_compat_crazy_substitutions=False,
+                 context=None,
+                 **kwargs):
+        walker.Visitor.__init__(self, ElementTree)
+        self.context = context
+        self.setUp(ElementTree, w3c_compat, w3c_compat_substitutions,
+                   w3c_compat_crazy_substitutions, **kwargs)
+        self.string_subs = self.getStringSubstitutions(
+            ElementTree, w3c_compat, w3c_compat_substitutions,
+            w3c_compat_crazy_substitutions, context=context, **kwargs)
+        self.markers = link_comments
+        if w3c_compat or w3c_compat_substitutions:
+            self.markers = self.markers | compat_comments
+        self.found_markers = False
+
+    def register(self, walk):
+        walk.register(text=self.substitute, comment=self.comment)
+
+    def substitute(self, node):
+        self.substituteNode(node, self.string_subs, self.context)
+
+    def comment(self, node):
+        if node.text.strip(utils.spaceCharacters) in self.markers:
+            self.found_markers = True
+
+    def finish(self, **kwargs):
+        # Only walk the tree again if there is anything to replace
+        if self.found_markers:
+            self.commentSubstitutions(self.ElementTree, **kwargs)
+
+
 class DifferentParentException(utils.AnolisException):
     """begin-link and end-link do not have the same parent."""
     pass
@@ -20,11 +20,128 @@
 # THE SOFTWARE.
 
 import re
+from bisect import bisect
 
 from lxml import etree
 from copy import deepcopy
 
-from anolislib import utils
+from anolislib import queries, utils
+
+# The XPath string-value of an element
+stringValue = queries.xpath("string()")
+
+# The dfns before a dfn, among its siblings, without ids
+unidentifiedDfnsBefore = queries.xpath("count(preceding-sibling::dfn[not(@id)])")
+
+# The descendants of a heading, or of the parent of a dfn, that can't be
+# copied into the index as they are
+linksAndIdentified = queries.xpath(".//*[self::dfn or @href or @id]")
+dfnsAndIdentified = queries.xpath(".//*[self::dfn or @id]")
+
+# What XPath's translate() with the ASCII alphabets and normalize-space() do
+ascii_lowercase = dict((ord(upper), ord(upper.lower()))
+                       for upper in "ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+xpath_spaces = re.compile("[\x20\x09\x0D\x0A]+")
+
+def normalizeTerm(text):
+    text = utils.unicode_type(text).translate(ascii_lowercase)
+    return xpath_spaces.sub(" ", text).strip(" ")
+
+class InstanceIndex(object):
+    """Map fragment identifiers to the <a> elements linking to them and the
+    elements with them as their id, in document order, as
+    //a[substring-after(@href,'#')=$id]|//*[@id=$id] would find them."""
+
+    def __init__(self, ElementTree):
+        self.positions = {}
+        self.instances = {}
+        for position, element in enumerate(ElementTree.iter(tag=etree.Element)):
+            self.positions[element] = position
+            href = element.get("href")
+            if element.tag == "a" and href is not None and "#" in href:
+                self.instances.setdefault(href.partition("#")[2], []).append(element)
+            id = element.get("id")
+            if id is not None:
+                instances = self.instances.setdefault(id, [])
+                if not instances or instances[-1] is not element:
+                    instances.append(element)
+
+    def get(self, id):
+        return self.instances.get(id, [])
+
+    def addID(self, element):
+        """Index element under its id, which it didn't have before."""
+        instances = self.instances.setdefault(element.get("id"), [])
+        if element in instances:
+            return
+        positions = [self.positions[instance] for instance in instances]
+        instances.insert(bisect(positions, self.positions[element]), element)
+
+class HeadingMap(object):
+    """Find the h1-h6 heading for the section that contains each node, and
+    keep a hyperlink made from each heading to copy for each use."""
+
+    def __init__(self):
+        self.headings = {}
+        self.templates = {}
+
+    def heading(self, node):
+        # look back through previous siblings and parents until we find a
+        # heading, remembering the answer for every node we pass on the way,
+        # as the search from any of them would end at the same heading
+        passed = []
+        while node is not None and node not in self.headings:
+            if isinstance(node.tag,str) and re.match("^[hH][1-6]$",node.tag):
+                self.headings[node] = node
+                break
+            passed.append(node)
+            if node.getprevious() == None:
+                node = node.getparent()
+            else:
+                node = node.getprevious()
+                # note from MikeSmith: dunno the purpose of the following; just
+                # ported it over as-is from Hixie's dfn.js because it's there
+                if isinstance(node.tag,str) and node.get("class") == "impl":
+                    node = node.getchildren()[-1]
+        heading = self.headings.get(node) if node is not None else None
+        for node in passed:
+            self.headings[node] = heading
+        return heading
+
+    def template(self, heading):
+        if heading in self.templates:
+            return self.templates[heading]
+        # we need a copy of this heading rather than the original node
+        headingLink = deepcopy(heading)
+        # turn this h1-h6 heading copy into <a> hyperlink back to the
+        # location of the target node
+        headingLink.tag = "a"
+        # this is a copy of an h1-h6 heading that may have had an id
+        # attribute; we don't want to duplicate the id, so drop it
+        if "id" in headingLink.attrib:
+            del headingLink.attrib["id"]
+        # some headings may contain descendants that are <a> links or
+        # <dfn>s, and/or that have id attributeds
+        embeddedLinks = linksAndIdentified(headingLink)
+        # we have taken a copy of what was a heading and transformed it
+        # into a hyperlink, and because it is a hyperlink, we now do not
+        # want it to itself contain descendant <a> links, nor any <dfn>s,
+        # so we transform those descendants into <span>s
+        for descendant in embeddedLinks:
+            if descendant.tag == "a" or descendant.tag == "dfn":
+                descendant.tag = "span"
+            # we need to remove any @href attributes left over in any
+            # descendants that we were <a> links
+            if "href" in descendant.attrib:
+                del descendant.attrib["href"]
+            # this descendant might be an <a> element that we added an
+            # id attribute to earlier and/or some other element with an ia
+            # attribute ; but we don't want to duplicate the id attributes
+            # here, so drop any id attribute we find
+            if "id" in descendant.attrib:
+                del descendant.attrib["id"]
+        self.templates[heading] = headingLink
+        return headingLink
 
 class terms(object):
     """Build and add an index of terms."""
@@ -32,7 +149,12 @@ class terms(object):
     terms = None
 
     def __init__(self, ElementTree, **kwargs):
+        # Share one context between everything done to the document, when
+        # not run by the generator
+        if kwargs.get("context") is None:
+            kwargs["context"] = utils.DocumentContext(ElementTree)
         self.terms = etree.Element(u"div",{u"class": "index-of-terms"})
+        self.headings = HeadingMap()
         self.buildTerms(ElementTree, **kwargs)
         self.addTerms(ElementTree, **kwargs)
 
@@ -53,11 +175,22 @@ class terms(object):
             # sort the list of <dfn> terms by the lowercase value of the DOM
             # textContent of the <dfn> element (concantentation of the <dfn>
             # text nodes and that of any of its descendant elements)
-            dfnList.sort(key=lambda dfn: utils.textContent(dfn).lower())
+            dfnList.sort(key=lambda dfn: utils.textContent(dfn, **kwargs).lower())
+            # index the links to, and ids of, everything once, rather than
+            # looking for the instances of each term in the whole document
+            instanceIndex = InstanceIndex(ElementTree)
+            # count the <dfn>s with each normalized, case-folded string value,
+            # so we can tell which terms are defined more than once
+            dfnCounts = {}
+            for dfn in dfnList:
+                normalized = normalizeTerm(stringValue(dfn))
+                dfnCounts[normalized] = dfnCounts.get(normalized, 0) + 1
             for dfn in dfnList:
                 # we don't need the tail, so copy the <dfn> and drop the tail
                 term = deepcopy(dfn)
                 term.tail = None
+                # the copy has the same text content as the <dfn> itself
+                termText = utils.textContent(dfn, **kwargs)
                 termID = None
                 dfnHasID = False
                 if dfn.get("id"):
@@ -79,7 +212,7 @@ class terms(object):
                     # and has any sibling <dfn>s that also lack id attributes,
                     # we need to further qualify the id attribute here to make
                     # it unique
-                    dfnSiblings = int(dfn.xpath("count(preceding-sibling::dfn[not(@id)])"))
+                    dfnSiblings = int(unidentifiedDfnsBefore(dfn))
                     if not dfnHasID and dfnSiblings > 0:
                         indexEntry = etree.Element(u"dl",{u"id": termID+"_"+str(dfnSiblings)+"_index"})
                     else:
@@ -94,14 +227,10 @@ class terms(object):
                     termName.append(term);
                     termName.tail= "\n"
                     indexEntry.append(termName)
-                    # normalize the text content of each <dfn> in the document
-                    # and then normalize the text content of this <dfn>, then
-                    # do a case-insensitive comparison of them and count how
-                    # many matches we have
-                    expr = "count(//dfn\
-                            [normalize-space(translate(.,'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'))\
-                            =normalize-space(translate($content,'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'))])"
-                    if ElementTree.xpath(expr, content = utils.textContent(term)) > 1:
+                    # normalize the text content of this <dfn>, and look up
+                    # how many <dfn>s in the document have a case-insensitive
+                    # match for it as their normalized text content
+                    if dfnCounts.get(normalizeTerm(termText), 0) > 1:
                         # we have more than one <dfn> in the document whose
                         # content is a case-insensitive match for the
                         # textContent of this <dfn>; so, we attempt to
@@ -138,7 +267,8 @@ class terms(object):
                             # remove ID so that we don't duplicate it
                             if "id" in dfnParentNode.attrib:
                                 del dfnParentNode.attrib["id"]
-                            descendants = dfnParentNode.xpath(".//*[self::dfn or @id]")
+                            descendants = dfnsAndIdentified(dfnParentNode)
+                            termTextLower = termText.lower()
                             for descendant in descendants:
                                 if descendant.tag == "dfn":
                                     descendant.tag = "span"
@@ -148,7 +278,7 @@ class terms(object):
                                 # same as the text content of the term, then we
                                 # don't want to repeat it, so instead we
                                 # replace it with ellipses
-                                if utils.textContent(descendant).lower() == utils.textContent(term).lower():
+                                if utils.textContent(descendant).lower() == termTextLower:
                                     tail = ""
                                     if descendant.tail is not None:
                                         tail = descendant.tail
@@ -167,7 +297,7 @@ class terms(object):
                             indexEntry.append(dfnContext)
                     # we need a first letter so that we can build navigational
                     # links for the alphabetic nav bars injected into the index
-                    termFirstLetter = utils.textContent(term)[0].upper()
+                    termFirstLetter = termText[0].upper()
                     if termFirstLetter != prevTermFirstLetter and termFirstLetter.isalpha():
                         firstLetters.append(termFirstLetter)
                         indexNavHelpers[termFirstLetter] = etree.Element(u"div",{u"class": "index-nav", u"id": "index-terms_"+termFirstLetter})
@@ -179,7 +309,7 @@ class terms(object):
                     # that is the defining instance of this term, as well as
                     # the <dfn> defining instance itself
                     # #########################################################
-                    instanceList = ElementTree.xpath("//a[substring-after(@href,'#')=$targetID]|//*[@id=$targetID]", targetID = termID)
+                    instanceList = list(instanceIndex.get(termID))
                     if instanceList:
                         instanceItem = None
                         lastLinkToHeading = None
@@ -189,8 +319,11 @@ class terms(object):
                             # without an id attribute, but we need each to have
                             # an id attribute so that we can link back to it
                             # from the index of terms; so, create an id for each
+                            hadID = instance.get("id") is not None
                             instanceID = utils.generateID(instance, **kwargs)
-                            instance.set(u"id",instanceID)
+                            utils.setID(instance, instanceID, **kwargs)
+                            if not hadID:
+                                instanceIndex.addID(instance)
                             # make a link that's a copy of the node of the h1-h6
                             # heading for the section that contains this
                             # instance hyperlink
@@ -286,49 +419,14 @@ class terms(object):
 
     def getAncestorHeadingLink(self, descendantNode, id):
         """ Given a node, return a link to the heading for the section that contains it."""
-        node = descendantNode
-        while (node is not None):
-            if isinstance(node.tag,str) and re.match("^[hH][1-6]$",node.tag):
-                # we need a copy of this heading rather than the original node
-                headingLink = deepcopy(node)
-                # turn this h1-h6 heading copy into <a> hyperlink back to the
-                # location of the target node
-                headingLink.tag = "a"
-                headingLink.set(u"href","#"+id)
-                # this is a copy of an h1-h6 heading that may have had an id
-                # attribute; we don't want to duplicate the id, so drop it
-                if "id" in headingLink.attrib:
-                    del headingLink.attrib["id"]
-                # some headings may contain descendants that are <a> links or
-                # <dfn>s, and/or that have id attributeds
-                embeddedLinks = headingLink.xpath(".//*[self::dfn or @href or @id]")
-                # we have taken a copy of what was a heading and transformed it
-                # into a hyperlink, and because it is a hyperlink, we now do not
-                # want it to itself contain descendant <a> links, nor any <dfn>s, 
-                # so we transform those descendants into <span>s
-                for descendant in embeddedLinks:
-                  if descendant.tag == "a" or descendant.tag == "dfn":
-                      descendant.tag = "span"
-                  # we need to remove any @href attributes left over in any
-                  # descendants that we were <a> links
-                  if "href" in descendant.attrib:
-                      del descendant.attrib["href"]
-                  # this descendant might be an <a> element that we added an
-                  # id attribute to earlier and/or some other element with an ia
-                  # attribute ; but we don't want to duplicate the id attributes
-                  # here, so drop any id attribute we find
-                  if "id" in descendant.attrib:
-                      del descendant.attrib["id"]
-                return headingLink
-            elif node.getprevious() == None:
-                node = node.getparent()
-            else:
-                node = node.getprevious()
-                # note from MikeSmith: dunno the purpose of the following; just
-                # ported it over as-is from Hixie's dfn.js because it's there
-                if isinstance(node.tag,str) and node.get("class") == "impl":
-                    node = node.getchildren()[-1]
-        return None
+        heading = self.headings.heading(descendantNode)
+        if heading is None:
+            return None
+        # copy the cleaned-up link we made from this heading the first time
+        # we needed it, and point it at the location of the target node
+        headingLink = deepcopy(self.headings.template(heading))
+        headingLink.set(u"href","#"+id)
+        return headingLink
 
     def addTerms(self, ElementTree, **kwargs):
         utils.replaceComment(ElementTree, u"index-terms", self.terms, **kwargs)
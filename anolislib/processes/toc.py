@@ -39,11 +39,15 @@ class toc(object):
     toc = None
 
     def __init__(self, ElementTree, **kwargs):
+        # Share one context between everything done to the document, when
+        # not run by the generator
+        if kwargs.get("context") is None:
+            kwargs["context"] = utils.DocumentContext(ElementTree)
         self.buildToc(ElementTree, **kwargs)
         self.addToc(ElementTree, **kwargs)
 
     def buildToc(self, ElementTree, min_depth=2, max_depth=6, w3c_compat=False,
-                 w3c_compat_class_toc=False, **kwargs):
+                 w3c_compat_class_toc=False, context=None, **kwargs):
         # Element to use for the toc
         list_tag = "ol"
         if w3c_compat or w3c_compat_class_toc:
@@ -52,8 +56,11 @@ class toc(object):
         self.toc = etree.Element(list_tag, {"class": "toc"})
 
         # Build the outline of the document
-        outline_creator = outliner.Outliner(ElementTree, **kwargs)
-        outline = outline_creator.build(**kwargs)
+        outline = outliner.getOutline(ElementTree, context=context, **kwargs)
+
+        # Whether there is anywhere for the TOC to go; if not, only number
+        # the headings and give them ids
+        entries = context is None or "toc" in context.markers.comments
 
         # Get a list of all the top level sections, and their depth (0)
         sections = [(section, 0) for section in reversed(outline)]
@@ -91,7 +98,8 @@ class toc(object):
                         # Copy content, to prepare for the node being
                         # removed
                         utils.copyContentForRemoval(element, text=False,
-                                                    children=False)
+                                                    children=False,
+                                                    context=context)
                         # Remove the element (we can do this as we're not
                         # iterating over the elements, but over a list)
                         element.getparent().remove(element)
@@ -119,9 +127,10 @@ class toc(object):
 
                 # Get the current TOC section for this depth, and add another
                 # item to it
-                if header_text is not None and \
-                   not utils.elementHasClass(header_text, "no-toc") or \
-                   header_text is None and section:
+                if entries and \
+                   (header_text is not None and
+                    not utils.elementHasClass(header_text, "no-toc") or
+                    header_text is None and section):
                     # Find the appropriate section of the TOC
                     i = 0
                     toc_section = self.toc
@@ -155,18 +164,22 @@ class toc(object):
                     # Add the current item to the TOC
                     item = etree.Element("li")
                     toc_section.append(item)
+                    if context is not None:
+                        context.count("toc_entries")
                     utils.indentNode(item, (i + 1) * 2 - 1, **kwargs)
 
                 # If we have a header
                 if header_text is not None:
                     # Add ID to header
-                    id = utils.generateID(header_text, **kwargs)
-                    if header_text.get("id") is not None:
-                        del header_text.attrib["id"]
-                    section.header.set("id", id)
+                    id = utils.generateID(header_text, context=context,
+                                          **kwargs)
+                    utils.removeID(header_text, context=context)
+                    utils.setID(section.header, id, context=context)
 
                     # Add number, if @class doesn't contain no-num
                     if not utils.elementHasClass(header_text, "no-num"):
+                        if context is not None:
+                            context.texts.invalidate(header_text)
                         header_text[0:0] = [etree.Element("span", {"class":
                                                                    "secno"})]
                         header_text[0].tail = header_text.text
@@ -174,7 +187,8 @@ class toc(object):
                         header_text[0].text = ".".join("%s" % n for n in num)
                         header_text[0].text += " "
                     # Add to TOC, if @class doesn't contain no-toc
-                    if not utils.elementHasClass(header_text, "no-toc"):
+                    if entries and \
+                       not utils.elementHasClass(header_text, "no-toc"):
                         link = deepcopy(header_text)
                         item.append(link)
                         # Make it link to the header
@@ -202,7 +216,8 @@ class toc(object):
                         # We don't want the old tail
                         link.tail = None
                         # Check we haven't changed the content in all of that
-                        assert utils.textContent(header_text) == \
+                        assert utils.textContent(header_text,
+                                                 context=context) == \
                                utils.textContent(link)
             # Add subsections in reverse order (so the next one is executed
             # next) with a higher depth value
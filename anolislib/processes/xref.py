@@ -29,7 +29,7 @@ try:
 except ImportError:
     import simplejson as json
 
-from anolislib import utils
+from anolislib import utils, walker
 
 instance_elements = frozenset(["span", "code"])
 instance_elements_a = frozenset(["a", "code"])
@@ -50,6 +50,10 @@ class xref(object):
     """Add cross-references."""
 
     def __init__(self, ElementTree, dump_xrefs='', dump_backrefs=False, **kwargs):
+        # Share one context between everything done to the document, when
+        # not run by the generator
+        if kwargs.get("context") is None:
+            kwargs["context"] = utils.DocumentContext(ElementTree)
         self.dfns = {}
         self.instances = {}
         self.buildReferences(ElementTree, dump_backrefs=dump_backrefs, **kwargs)
@@ -59,27 +63,33 @@ class xref(object):
         if dump_backrefs:
             self.dump(self.instances, "backrefs.json", **kwargs)
 
-    def buildReferences(self, ElementTree, allow_duplicate_dfns=False,
-                        **kwargs):
+    def buildReferences(self, ElementTree, **kwargs):
         for dfn in ElementTree.iter("dfn"):
-            terms = self.getTerm(dfn, **kwargs).split("|")
-            for term in set(t for t in terms if t):
-                if not allow_duplicate_dfns and term in self.dfns:
-                    raise DuplicateDfnException('The term "%s" is defined more than once' % term)
+            self.addDfn(dfn, **kwargs)
 
-                link_to = dfn
+    def addDfn(self, dfn, allow_duplicate_dfns=False, context=None,
+               **kwargs):
+        if context is not None:
+            context.count("dfns")
+        kwargs["context"] = context
+        terms = self.getTerm(dfn, **kwargs).split("|")
+        for term in set(t for t in terms if t):
+            if not allow_duplicate_dfns and term in self.dfns:
+                raise DuplicateDfnException('The term "%s" is defined more than once' % term)
 
-                for parent_element in dfn.iterancestors(tag=etree.Element):
-                    if parent_element.tag in utils.heading_content:
-                        link_to = parent_element
-                        break
+            link_to = dfn
 
-                id = utils.generateID(link_to, **kwargs)
+            for parent_element in dfn.iterancestors(tag=etree.Element):
+                if parent_element.tag in utils.heading_content:
+                    link_to = parent_element
+                    break
 
-                link_to.set("id", id)
+            id = utils.generateID(link_to, **kwargs)
 
-                self.dfns[term] = id
-                self.instances[term] = []
+            utils.setID(link_to, id, **kwargs)
+
+            self.dfns[term] = id
+            self.instances[term] = []
 
     def getDfns(self, dump_xrefs, **kwargs):
         try:
@@ -98,68 +108,83 @@ It should contain a an object with a 'url' property (whose value ends with a '#'
         fp.write(d + "\n")
         fp.close()
 
-    def addReferences(self, ElementTree, w3c_compat=False,
-                      w3c_compat_xref_elements=False,
-                      w3c_compat_xref_a_placement=False,
-                      xref_use_a=False,
-                      use_strict=False,
-                      dump_backrefs=False,
-                      **kwargs):
-        for element in ElementTree.iter(tag=etree.Element):
-            if (not xref_use_a and element.tag in instance_elements) or \
+    def addReferences(self, ElementTree, **kwargs):
+        finder = utils.InstanceFinder(
+            lambda element: self.isInstance(element, **kwargs), isBlocking)
+        self.addInstances(finder.find(ElementTree), **kwargs)
+
+    def addInstances(self, instances, **kwargs):
+        # Whether each instance, or one of its ancestors, ended up as or in a
+        # link; instances come in document order, so ancestors come first
+        linked = []
+        for element, blocked, parent in instances:
+            in_link = parent is not None and linked[parent]
+            linked.append(self.addReference(element,
+                                            blocked=blocked or in_link,
+                                            **kwargs) or in_link)
+
+    def isInstance(self, element, w3c_compat=False,
+                   w3c_compat_xref_elements=False, xref_use_a=False,
+                   **kwargs):
+        return (not xref_use_a and element.tag in instance_elements) or \
                (xref_use_a and element.tag in instance_elements_a and element.get("href") is None) or \
                (w3c_compat or w3c_compat_xref_elements) and \
-               element.tag in w3c_instance_elements:
-                term = self.getTerm(element, w3c_compat=w3c_compat, **kwargs)
-
-                if term in self.dfns:
-                    goodParentingAndChildren = True
-
-                    for parent_element in \
-                        element.iterancestors(tag=etree.Element):
-                        if (parent_element.tag in instance_not_in_stack_with or
-                            utils.isInteractiveContent(parent_element)):
-                            goodParentingAndChildren = False
-                            break
+               element.tag in w3c_instance_elements
+
+    def addReference(self, element, blocked=None, w3c_compat=False,
+                     w3c_compat_xref_a_placement=False,
+                     use_strict=False,
+                     dump_backrefs=False,
+                     context=None,
+                     **kwargs):
+        """Link element to its dfn, if any, returning whether it did so.
+
+        blocked says whether element has a dfn or interactive content as an
+        ancestor or descendant; it gets looked up in the tree if not given."""
+        term = self.getTerm(element, w3c_compat=w3c_compat,
+                            context=context, **kwargs)
+
+        if term in self.dfns:
+            if blocked is None:
+                blocked = isBlockedInTree(element)
+
+            if not blocked and element.get("data-anolis-spec") is None:
+                if context is not None:
+                    context.texts.invalidate(element)
+                if element.tag == "span" or element.tag == "a":
+                    element.tag = "a"
+                    element.set("href", "#" + self.dfns[term])
+                    link = element
+                else:
+                    link = etree.Element("a",
+                                         {"href":
+                                          "#" + self.dfns[term]})
+                    if w3c_compat or w3c_compat_xref_a_placement:
+                        for node in element:
+                            link.append(node)
+                        link.text = element.text
+                        element.text = None
+                        element.append(link)
                     else:
-                        for child_element in \
-                            element.iterdescendants(tag=etree.Element):
-                            if child_element.tag in instance_not_in_stack_with\
-                               or utils.isInteractiveContent(child_element):
-                                goodParentingAndChildren = False
-                                break
-
-                    if goodParentingAndChildren and element.get("data-anolis-spec") is None:
-                        if element.tag == "span" or element.tag == "a":
-                            element.tag = "a"
-                            element.set("href", "#" + self.dfns[term])
-                            link = element
-                        else:
-                            link = etree.Element("a",
-                                                 {"href":
-                                                  "#" + self.dfns[term]})
-                            if w3c_compat or w3c_compat_xref_a_placement:
-                                for node in element:
-                                    link.append(node)
-                                link.text = element.text
-                                element.text = None
-                                element.append(link)
-                            else:
-                                element.addprevious(link)
-                                link.append(element)
-                                link.tail = link[0].tail
-                                link[0].tail = None
-                        if dump_backrefs:
-                            t = utils.non_ifragment.sub("-", term.strip(utils.spaceCharacters)).strip("-")
-                            id = "instance_" + t + "_" + str(len(self.instances[term]))
-                            link.set("id", id)
-                            self.instances[term].append(id)
-                elif use_strict and term and \
-                     not utils.elementHasClass(element, "secno") and \
-                     not "data-anolis-spec" in element.attrib and \
-                     not "data-anolis-ref" in element.attrib and \
-                     not element.getparent().tag in instance_not_in_stack_with:
-                    raise SyntaxError("Term not defined: %s, %s." % (term, element))
+                        element.addprevious(link)
+                        link.append(element)
+                        link.tail = link[0].tail
+                        link[0].tail = None
+                if dump_backrefs:
+                    t = utils.non_ifragment.sub("-", term.strip(utils.spaceCharacters)).strip("-")
+                    id = "instance_" + t + "_" + str(len(self.instances[term]))
+                    utils.setID(link, id, context=context)
+                    self.instances[term].append(id)
+                if context is not None:
+                    context.count("xrefs")
+                return True
+        elif use_strict and term and \
+             not utils.elementHasClass(element, "secno") and \
+             not "data-anolis-spec" in element.attrib and \
+             not "data-anolis-ref" in element.attrib and \
+             not element.getparent().tag in instance_not_in_stack_with:
+            raise SyntaxError("Term not defined: %s, %s." % (term, element))
+        return False
 
     def getTerm(self, element, w3c_compat=False,
                 w3c_compat_xref_normalization=False, **kwargs):
@@ -170,7 +195,7 @@ It should contain a an object with a 'url' property (whose value ends with a '#'
         elif element.get("title") is not None:
             term = element.get("title")
         else:
-            term = utils.textContent(element)
+            term = utils.textContent(element, **kwargs)
 
         term = term.strip(utils.spaceCharacters).lower()
 
@@ -182,6 +207,56 @@ It should contain a an object with a 'url' property (whose value ends with a '#'
         return term
 
 
+class Visitor(xref, walker.Visitor):
+    """Add cross-references, finding dfns and instances in a shared tree
+       walk."""
+
+    # All the dfns have to be known before adding any references
+    barrier = True
+    classic_walks = 2
+
+    def __init__(self, ElementTree, **kwargs):
+        walker.Visitor.__init__(self, ElementTree)
+        self.dfns = {}
+        self.instances = {}
+        self.dfn_elements = []
+        self.finder = utils.InstanceFinder(
+            lambda element: self.isInstance(element, **kwargs), isBlocking)
+
+    def register(self, walk):
+        walk.register(start=self.collect, end=self.finder.end)
+
+    def collect(self, element):
+        if element.tag == "dfn":
+            self.dfn_elements.append(element)
+        self.finder.start(element)
+
+    def finish(self, dump_xrefs='', dump_backrefs=False, **kwargs):
+        for dfn in self.dfn_elements:
+            self.addDfn(dfn, **kwargs)
+        if dump_xrefs:
+            self.dump(self.getDfns(dump_xrefs), dump_xrefs, **kwargs)
+        self.addInstances(self.finder.instances, dump_backrefs=dump_backrefs,
+                          **kwargs)
+        if dump_backrefs:
+            self.dump(self.instances, "backrefs.json", **kwargs)
+
+
+def isBlocking(element):
+    return (element.tag in instance_not_in_stack_with or
+            utils.isInteractiveContent(element))
+
+
+def isBlockedInTree(element):
+    for other in element.iterancestors(tag=etree.Element):
+        if isBlocking(other):
+            return True
+    for other in element.iterdescendants(tag=etree.Element):
+        if isBlocking(other):
+            return True
+    return False
+
+
 class DuplicateDfnException(utils.AnolisException):
     """Term already defined."""
     pass
@@ -24,12 +24,7 @@ from __future__ import unicode_literals
 
 from lxml import etree
 
-try:
-  import json
-except ImportError:
-  import simplejson as json
-
-from anolislib import utils
+from anolislib import queries, utils, xrefdb
 
 instance_elements = frozenset(["span", "code"])
 instance_elements_a = frozenset(["a", "code"])
@@ -43,6 +38,9 @@ w3c_instance_elements = frozenset(["abbr", "acronym", "b", "bdo", "big",
 # interactive elements
 instance_not_in_stack_with = frozenset(["dfn", ])
 
+# The specifications elements in the document refer to
+referenced_specs = queries.xpath("//@data-anolis-spec")
+
 class xspecxref(object):
   """Add cross-references."""
 
@@ -53,14 +51,25 @@ class xspecxref(object):
     self.addReferences(ElementTree, **kwargs)
 
   def buildReferences(self, ElementTree, xref="data", allow_duplicate_dfns=False, **kwargs):
-    manifest = open(xref + "/specs.json", "r")
-    specs = json.load(manifest)
-    manifest.close()
-
-    for (k, v) in specs.items():
-      file = open(xref + "/xrefs/" + v, "r")
-      dfn = json.load(file)
-      file.close()
+    referenced = set(referenced_specs(ElementTree))
+
+    # Look the specifications up in the compiled database, if there is one
+    database = xrefdb.connect(xref)
+    if database is not None:
+      for k in referenced:
+        spec = database.spec(k)
+        if spec is not None:
+          self.dfns[k] = spec
+      return
+
+    specs = utils.loadJSON(xref + "/specs.json")
+
+    # Only load the definitions of the specifications the document refers
+    # to; any others it names are left for addReferences to complain about
+    for k in referenced:
+      if k not in specs:
+        continue
+      dfn = utils.loadJSON(xref + "/xrefs/" + specs[k])
       self.dfns[k] = { "url" : dfn["url"], "values" : dfn["definitions"] }
 
   def addReferences(self, ElementTree, w3c_compat=False,
@@ -68,66 +77,64 @@ class xspecxref(object):
                     w3c_compat_xref_a_placement=False,
                     xref_use_a=False,
                     use_strict=False,
+                    context=None,
                     **kwargs):
-    for element in ElementTree.iter(tag=etree.Element):
-      if (((not xref_use_a and element.tag in instance_elements)
+    def isInstance(element):
+      return (((not xref_use_a and element.tag in instance_elements)
           or (xref_use_a and element.tag in instance_elements_a and element.get("href") is None)
           or (w3c_compat or w3c_compat_xref_elements)
           and element.tag in w3c_instance_elements)
-          and (element.get("data-anolis-spec") is not None)):
-        term = self.getTerm(element, **kwargs)
-        spec = element.get("data-anolis-spec")
-        if w3c_compat:
-          del element.attrib["data-anolis-spec"]
-        if element.get("class") is not None:
-          element.set("class", element.get("class") + " external")
-        else:
-          element.set("class", "external")
-
-        if not spec in self.dfns or not self.dfns[spec]:
-          raise SyntaxError("Specification not found: %s." % spec)
-        if not self.dfns[spec]["values"]:
-          raise SyntaxError("No values for specification: %s." % spec)
-        if not term in self.dfns[spec]["values"]:
-          self.notfound.append([term, spec])
-          continue
-
-        obj = self.dfns[spec]
-        goodParentingAndChildren = True
-
-        for parent_element in \
-          element.iterancestors(tag=etree.Element):
-          if (parent_element.tag in instance_not_in_stack_with or
-            utils.isInteractiveContent(parent_element)):
-            goodParentingAndChildren = False
-            break
+          and (element.get("data-anolis-spec") is not None))
+
+    # Whether each instance, or one of its ancestors, ended up as or in a
+    # link; instances come in document order, so ancestors come first
+    linked = []
+    finder = utils.InstanceFinder(isInstance, isBlocking)
+    for element, blocked, parent in finder.find(ElementTree):
+      in_link = parent is not None and linked[parent]
+      linked.append(in_link)
+      term = self.getTerm(element, context=context, **kwargs)
+      spec = element.get("data-anolis-spec")
+      if w3c_compat:
+        del element.attrib["data-anolis-spec"]
+      if element.get("class") is not None:
+        element.set("class", element.get("class") + " external")
+      else:
+        element.set("class", "external")
+
+      if not spec in self.dfns or not self.dfns[spec]:
+        raise SyntaxError("Specification not found: %s." % spec)
+      if not self.dfns[spec]["values"]:
+        raise SyntaxError("No values for specification: %s." % spec)
+      if not term in self.dfns[spec]["values"]:
+        self.notfound.append([term, spec])
+        continue
+
+      obj = self.dfns[spec]
+
+      if not blocked and not in_link:
+        linked[-1] = True
+        if context is not None:
+          context.texts.invalidate(element)
+          context.count("xrefs")
+        if element.tag == "span" or element.tag == "a":
+          element.tag = "a"
+          element.set("href", obj["url"] + obj["values"][term])
         else:
-          for child_element in \
-            element.iterdescendants(tag=etree.Element):
-            if child_element.tag in instance_not_in_stack_with\
-               or utils.isInteractiveContent(child_element):
-              goodParentingAndChildren = False
-              break
-
-        if goodParentingAndChildren:
-          if element.tag == "span" or element.tag == "a":
-            element.tag = "a"
-            element.set("href", obj["url"] + obj["values"][term])
+          link = etree.Element("a",
+                     {"href":
+                      obj["url"] + obj["values"][term]})
+          if w3c_compat or w3c_compat_xref_a_placement:
+            for node in element:
+              link.append(node)
+            link.text = element.text
+            element.text = None
+            element.append(link)
           else:
-            link = etree.Element("a",
-                       {"href":
-                        obj["url"] + obj["values"][term]})
-            if w3c_compat or w3c_compat_xref_a_placement:
-              for node in element:
-                link.append(node)
-              link.text = element.text
-              element.text = None
-              element.append(link)
-            else:
-              element.addprevious(link)
-              link.append(element)
-              link.tail = link[0].tail
-              link[0].tail = None
+            element.addprevious(link)
+            link.append(element)
+            link.tail = link[0].tail
+            link[0].tail = None
     if self.notfound:
       raise SyntaxError("Terms not defined: %s." % self.notfound)
 
@@ -140,8 +147,13 @@ class xspecxref(object):
     elif element.get("title") is not None:
       term = element.get("title")
     else:
-      term = utils.textContent(element)
+      term = utils.textContent(element, **kwargs)
 
     term = term.strip(utils.spaceCharacters).lower()
 
     return utils.spacesRegex.sub(" ", term)
+
+
+def isBlocking(element):
+  return (element.tag in instance_not_in_stack_with or
+      utils.isInteractiveContent(element))
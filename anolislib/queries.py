@@ -0,0 +1,92 @@
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""XPath expressions and CSS selectors, each compiled the first time it is
+used and then kept for every document processed after, along with how long
+compiling and evaluating them has taken.
+
+Anything that varies between uses should be an XPath variable, given when
+evaluating, rather than part of the expression, so that it only gets
+compiled once."""
+
+from __future__ import unicode_literals
+
+import time
+
+from lxml import etree
+
+# Every query compiled so far, by kind and expression
+compiled = {}
+
+# How many queries got compiled and evaluated, and how long that took
+stats = dict.fromkeys(["compiles", "compile_seconds", "evaluations",
+                       "evaluate_seconds"], 0)
+
+
+class Query(object):
+    """A compiled XPath expression or CSS selector, which gets called with
+    the node to evaluate it on, and any XPath variables as keyword
+    arguments."""
+
+    def __init__(self, expression, evaluator):
+        self.expression = expression
+        self.evaluator = evaluator
+
+    def __call__(self, node, **variables):
+        start = time.time()
+        try:
+            return self.evaluator(node, **variables)
+        finally:
+            stats["evaluations"] += 1
+            stats["evaluate_seconds"] += time.time() - start
+
+    def __repr__(self):
+        return "<Query %s>" % self.expression
+
+
+def compileQuery(kind, expression, compiler):
+    key = (kind, expression)
+    if key not in compiled:
+        start = time.time()
+        compiled[key] = Query(expression, compiler(expression))
+        stats["compiles"] += 1
+        stats["compile_seconds"] += time.time() - start
+    return compiled[key]
+
+
+def xpath(expression):
+    """The Query for the given XPath expression."""
+    return compileQuery("xpath", expression, etree.XPath)
+
+
+def selector(expression):
+    """The Query for the given CSS selector."""
+    from lxml import cssselect
+    return compileQuery("css", expression, cssselect.CSSSelector)
+
+
+def snapshot():
+    return dict(stats)
+
+
+def since(before):
+    """How many queries got compiled and evaluated, and how long that took,
+    since the given snapshot()."""
+    return dict((key, stats[key] - before[key]) for key in stats)
@@ -0,0 +1,233 @@
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""The processes anolis knows of, and what it knows about them.
+
+The built-in processes get registered here. Others come from the
+"anolis.processes" entry point group: an entry point names the process,
+and refers either to a Process or to the module with a callable of the
+same name in it. Failing that, as before there were entry points, a module
+with the name of the process on sys.path will do."""
+
+from __future__ import unicode_literals
+
+import importlib
+import os
+import types
+
+from anolislib import utils
+
+# Every process looked up so far, by name
+processes = {}
+
+
+class Process(object):
+    """A process: where it lives, and what it needs and does.
+
+    The module, named or given, has a callable, with the name of the process
+    unless said otherwise, taking the tree and options, and may have a
+    walker.Visitor called Visitor. data_files are the paths, in the --xref
+    directory, of the files the process reads, with directories ending in a
+    slash; mutates_ids says whether it adds, changes or removes ids other
+    than through the utils.IDRegistry of the context, which then has to look
+    at the document afresh after it; comments are the names of the comments
+    it replaces, whether on their own (as in <!--toc-->) or as begin- and
+    end- pairs; after are the processes that it has to run after, if they get
+    run at all.
+
+    triggers, if given, say when the process has anything to do: only when
+    the document has any of the "comments", "elements", "attributes" or
+    "ids" listed in it (as in utils.MarkerScan), or when any of the
+    "options" listed is set. adds_markers says whether the process might
+    add any of those for the processes after it."""
+
+    def __init__(self, name, module, function=None, data_files=(),
+                 mutates_ids=False, comments=(), after=(), triggers=None,
+                 adds_markers=True):
+        self.name = name
+        self.module = module
+        self.function_name = function or name
+        self.data_files = tuple(data_files)
+        self.mutates_ids = mutates_ids
+        self.comments = frozenset(comments)
+        self.after = tuple(after)
+        self.triggers = triggers
+        self.adds_markers = adds_markers
+
+    def load(self):
+        """Import the module of the process, once."""
+        if not isinstance(self.module, types.ModuleType):
+            self.module = importlib.import_module(str(self.module))
+        return self.module
+
+    @property
+    def function(self):
+        return getattr(self.load(), self.function_name)
+
+    @property
+    def visitor(self):
+        return getattr(self.load(), "Visitor", None)
+
+    def needed(self, markers, **kwargs):
+        """Whether the process has anything to do, going by the MarkerScan
+        of the document and the options."""
+        if self.triggers is None:
+            return True
+        for option in self.triggers.get("options", ()):
+            if kwargs.get(option):
+                return True
+        return markers.has(self.triggers)
+
+    def __repr__(self):
+        return "<Process %s>" % self.name
+
+
+def register(process):
+    """Make the given Process available by its name."""
+    processes[process.name] = process
+    return process
+
+
+def builtin(name, **kwargs):
+    return register(Process(name, "anolislib.processes." + name,
+                            adds_markers=False, **kwargs))
+
+
+headings = ["h1", "h2", "h3", "h4", "h5", "h6"]
+
+# These all give elements ids, and take them away, through the context
+builtin("filter")
+builtin("sub", comments=["link", "logo", "copyright"])
+builtin("toc", comments=["toc"],
+        triggers={"comments": ["toc"], "elements": headings})
+builtin("xref")
+builtin("xspecxref", data_files=["specs.json", "xrefs/"],
+        triggers={"attributes": ["data-anolis-spec"]})
+builtin("refs", data_files=["references.json"],
+        triggers={"attributes": ["data-anolis-ref"],
+                  "ids": ["anolis-references"], "options": ["dump_refs"]})
+builtin("terms", comments=["index-terms"],
+        triggers={"comments": ["index-terms"], "elements": ["dfn"]})
+builtin("lof",
+        triggers={"elements": ["table"], "ids": ["anolis-listoftables"]})
+builtin("replaceHeadings")
+builtin("annotate")
+
+
+def fromEntryPoint(name):
+    """The Process an "anolis.processes" entry point provides by the given
+    name, if any."""
+    try:
+        import pkg_resources
+    except ImportError:
+        return None
+    for entry_point in pkg_resources.iter_entry_points("anolis.processes",
+                                                       name):
+        provided = entry_point.load()
+        if isinstance(provided, Process):
+            return provided
+        # Nothing says it keeps the ids of the context up to date
+        return Process(name, provided, mutates_ids=True)
+    return None
+
+
+def get(name):
+    """The Process with the given name, which gets looked for the first time
+    it is asked for."""
+    try:
+        return processes[name]
+    except KeyError:
+        pass
+    process = fromEntryPoint(name)
+    if process is None:
+        process = Process(name, name, mutates_ids=True)
+        try:
+            process.load()
+        except ImportError:
+            raise UnknownProcessException("No such process: %s" % name)
+    return register(process)
+
+
+def comments():
+    """The names of the comments any process looked up so far replaces."""
+    return frozenset().union(*(process.comments
+                               for process in processes.values()))
+
+
+def pipeline(names):
+    """The Processes with the given names, in the order given, as many times
+    as each is given, except that where one has to run after another given
+    later, the last of that other gets moved ahead of it."""
+    requested = [get(name) for name in names]
+    last = dict((name, i) for i, name in enumerate(names))
+
+    ordered = []
+    placed = set()
+
+    def place(i, pending):
+        if i in placed:
+            return
+        process = requested[i]
+        if process.name in pending:
+            raise ProcessOrderException("Processes have to run after each "
+                                        "other: %s" % ", ".join(pending))
+        pending.append(process.name)
+        for name in process.after:
+            if name in last:
+                place(last[name], pending)
+        pending.pop()
+        placed.add(i)
+        ordered.append(process)
+
+    for i in range(len(names)):
+        place(i, [])
+    return ordered
+
+
+def dataFiles(names, xref="data"):
+    """The paths of the data files the named processes use in the given
+    xref directory, as they are now."""
+    paths = []
+    for name in names:
+        try:
+            process = get(name)
+        except utils.AnolisException:
+            continue
+        for path in process.data_files:
+            path = os.path.join(xref, path)
+            if not path.endswith("/"):
+                paths.append(path)
+                continue
+            try:
+                paths.extend(os.path.join(path, file_name)
+                             for file_name in sorted(os.listdir(path)))
+            except OSError:
+                pass
+    return paths
+
+
+class UnknownProcessException(utils.AnolisException):
+    """There is no process by the given name."""
+    pass
+
+
+class ProcessOrderException(utils.AnolisException):
+    """Processes have to run after each other."""
+    pass
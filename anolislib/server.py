@@ -0,0 +1,128 @@
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Keep anolis running, with everything imported and its data files loaded,
+and process documents sent to it over a Unix socket.
+
+A request is a JSON header, holding the options to process the document
+with and the working directory to do so in, followed by the input document.
+The response is a JSON header, holding an error message if processing
+failed, followed by the output document. Each of these is sent as its
+length, as four big-endian bytes, followed by that many bytes."""
+
+from __future__ import unicode_literals
+
+from io import BytesIO
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import traceback
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from lxml import etree
+
+from anolislib import generator, utils
+
+length_format = struct.Struct(b"!I")
+
+
+def sendMessage(connection, data):
+    connection.sendall(length_format.pack(len(data)) + data)
+
+
+def receiveExactly(connection, length):
+    chunks = []
+    while length:
+        chunk = connection.recv(min(length, 65536))
+        if not chunk:
+            raise EOFError("Connection closed mid-message")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+
+def receiveMessage(connection):
+    length, = length_format.unpack(receiveExactly(connection,
+                                                  length_format.size))
+    return receiveExactly(connection, length)
+
+
+def processRequest(header, input):
+    """Process a document as anolis would, in the client's working
+    directory, returning the output."""
+    kwargs = dict((str(key), value)
+                  for key, value in header["options"].items())
+    cwd = os.getcwd()
+    os.chdir(header["cwd"])
+    try:
+        tree = generator.fromFile(BytesIO(input), **kwargs)
+        return generator.toString(tree, **kwargs)
+    finally:
+        os.chdir(cwd)
+
+
+def handle(connection):
+    header = json.loads(receiveMessage(connection).decode("utf-8"))
+    input = receiveMessage(connection)
+    response = {}
+    output = b""
+    try:
+        output = processRequest(header, input)
+    except (utils.AnolisException, IOError, etree.XMLSyntaxError) as e:
+        response["error"] = "%s" % e
+    except Exception:
+        # Keep serving whatever goes wrong with one document
+        response["error"] = traceback.format_exc()
+    sendMessage(connection, json.dumps(response).encode("utf-8"))
+    sendMessage(connection, output)
+
+
+def serve(path, **kwargs):
+    """Serve requests on a Unix socket at path until interrupted."""
+    # Replace the socket left behind by a server that didn't shut down
+    # cleanly, but nothing else
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+    # Clean up on being told to stop, as well as on being interrupted
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            connection, address = server.accept()
+            try:
+                handle(connection)
+            except (socket.error, EOFError, ValueError) as e:
+                sys.stderr.write("Dropped request: %s\n" % e)
+            finally:
+                connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(path)
@@ -0,0 +1,93 @@
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import sys
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peakMemory():
+    """The most memory the process has had resident so far, in KiB, if the
+    platform says."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Which is in bytes on Mac OS X, and KiB everywhere else
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+
+class Timings(object):
+    """Record how long each phase of generating a document (parsing, each
+    process, serializing) took and the peak memory use by the end of it,
+    along with the counts the processes kept in the DocumentContext and how
+    long their queries took to compile and evaluate."""
+
+    def __init__(self):
+        self.phases = []
+        self.counts = {}
+        self.walks = {}
+        self.queries = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append({"name": name,
+                                "seconds": time.time() - start,
+                                "peak_memory_kib": peakMemory()})
+
+    def dump(self, f):
+        data = {"phases": self.phases,
+                "total_seconds": sum(phase["seconds"]
+                                     for phase in self.phases),
+                "counts": self.counts,
+                "walks": self.walks,
+                "queries": self.queries}
+        fp = open(f, "w")
+        fp.write(json.dumps(data, sort_keys=True, indent=2,
+                            separators=(',', ': ')) + "\n")
+        fp.close()
+
+
+@contextmanager
+def phase(timings, name):
+    """Time a phase in timings, if there are any being kept."""
+    if timings is None:
+        yield
+    else:
+        with timings.phase(name):
+            yield
@@ -22,10 +22,18 @@
 from __future__ import unicode_literals
 
 from copy import deepcopy
+import os
 import re
 import sys
 from lxml import etree
 
+from anolislib import queries
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 from html5lib.constants import spaceCharacters
 
 if sys.version_info[0] == 3:
@@ -35,8 +43,6 @@ else:
     str_type = basestring
     unicode_type = unicode
 
-ids = {}
-
 spaceCharacters = "".join(spaceCharacters)
 spacesRegex = re.compile("[%s]+" % spaceCharacters)
 
@@ -46,9 +52,27 @@ sectioning_content = frozenset(["section", "nav", "article", "aside"])
 sectioning_root = frozenset(["body", "blockquote", "figure", "td",
                              "datagrid"])
 
+# Elements that can change the outline of a document
+outline_content = heading_content | sectioning_content | sectioning_root
+
 always_interactive_content = frozenset(["a", "bb", "details", "datagrid"])
 media_elements = frozenset(["audio", "video"])
 
+# Public identifiers of DOCTYPEs that need HTML 4 compliant ids
+html4_public_ids = frozenset([
+    "-//W3C//DTD HTML 4.0//EN",
+    "-//W3C//DTD HTML 4.0 Transitional//EN",
+    "-//W3C//DTD HTML 4.0 Frameset//EN",
+    "-//W3C//DTD HTML 4.01//EN",
+    "-//W3C//DTD HTML 4.01 Transitional//EN",
+    "-//W3C//DTD HTML 4.01 Frameset//EN",
+    "ISO/IEC 15445:2000//DTD HyperText Markup Language//EN",
+    "ISO/IEC 15445:2000//DTD HTML//EN",
+    "-//W3C//DTD XHTML 1.0 Strict//EN",
+    "-//W3C//DTD XHTML 1.0 Transitional//EN",
+    "-//W3C//DTD XHTML 1.0 Frameset//EN",
+    "-//W3C//DTD XHTML 1.1//EN"])
+
 non_sgml_name = re.compile("[^A-Za-z0-9_:.]+")
 
 if sys.maxunicode == 0xFFFF:
@@ -71,32 +95,25 @@ def elementHasClass(Element, class_name):
         return False
 
 
-def generateID(Element, force_html4_id=False, **kwargs):
+def generateID(Element, force_html4_id=False, context=None, **kwargs):
     if Element.get("id") is not None:
         return Element.get("id")
     elif Element.get("title") is not None and \
          Element.get("title").strip(spaceCharacters) != "":
         source = Element.get("title")
     else:
-        source = textContent(Element)
+        source = textContent(Element, context=context)
 
     source = source.strip(spaceCharacters).lower()
 
+    # Processes pass the context of the document; anything else gets one
+    # just for this id
+    if context is None:
+        context = DocumentContext(Element.getroottree())
+
     if source == "":
         source = "generatedID"
-    elif force_html4_id or Element.getroottree().docinfo.public_id in \
-        ("-//W3C//DTD HTML 4.0//EN",
-         "-//W3C//DTD HTML 4.0 Transitional//EN",
-         "-//W3C//DTD HTML 4.0 Frameset//EN",
-         "-//W3C//DTD HTML 4.01//EN",
-         "-//W3C//DTD HTML 4.01 Transitional//EN",
-         "-//W3C//DTD HTML 4.01 Frameset//EN",
-         "ISO/IEC 15445:2000//DTD HyperText Markup Language//EN",
-         "ISO/IEC 15445:2000//DTD HTML//EN",
-         "-//W3C//DTD XHTML 1.0 Strict//EN",
-         "-//W3C//DTD XHTML 1.0 Transitional//EN",
-         "-//W3C//DTD XHTML 1.0 Frameset//EN",
-         "-//W3C//DTD XHTML 1.1//EN"):
+    elif force_html4_id or context.html4_doctype:
         source = non_sgml_name.sub("-", source).strip("-")
         try:
             if not source[0].isalpha():
@@ -108,86 +125,101 @@ def generateID(Element, force_html4_id=False, **kwargs):
         if source == "":
             source = "generatedID"
 
-    # Initally set the id to the source
-    id = source
-
-    i = 0
-    while getElementById(Element.getroottree().getroot(), id) is not None:
-        id = "%s-%i" % (source, i)
-        i += 1
-
-    ids[Element.getroottree().getroot()][id] = Element
-
-    return id
-
-
-def textContent(Element):
-    # Copy the element and get ready for removals
-    Element = deepcopy(Element)
-    to_remove = set()
-    
-    # Replace img with its alt attribute
-    for child in Element.iter(tag="img"):
-        # Add alt in its place
-        if child.get("alt") is not None:
-            if child.getprevious() is not None:
-                if child.getprevious().tail is None:
-                    child.getprevious().tail = child.get("alt")
-                else:
-                    child.getprevious().tail += child.get("alt")
-            else:
-                if child.getparent().text is None:
-                    child.getparent().text = child.get("alt")
-                else:
-                    child.getparent().text += child.get("alt")
-        # Preserve the element tail
-        if child.tail is not None:
-            if child.getprevious() is not None:
-                if child.getprevious().tail is None:
-                    child.getprevious().tail = child.tail
-                else:
-                    child.getprevious().tail += child.tail
-            else:
-                if child.getparent().text is None:
-                    child.getparent().text = child.tail
-                else:
-                    child.getparent().text += child.tail
-        # Get ready to remove the element
-        to_remove.add(child)
-        
-    # Remove to_remove nodes
-    for node in to_remove:
-        node.getparent().remove(node)
-    
-    # Then just use tostring
-    return etree.tostring(Element, encoding=unicode_type, method='text',
-                          with_tail=False)
+    # Use the source if we can, or else the first of source-0, source-1, ...
+    # that's still free
+    context.count("generated_ids")
+    return context.ids.allocate(source, Element)
 
 
-def getElementById(base, id):
-    if base in ids:
-        try:
-            return ids[base][id]
-        except KeyError:
-            return None
+def setID(Element, id, context=None, **kwargs):
+    if context is not None:
+        context.ids.set(Element, id)
     else:
-        ids[base] = {}
-        for element in base.iter(tag=etree.Element):
-            if element.get("id"):
-                ids[base][element.get("id")] = element
-        return getElementById(base, id)
+        Element.set("id", id)
+
+
+def removeID(Element, context=None, **kwargs):
+    if context is not None:
+        context.ids.remove(Element)
+    elif Element.get("id") is not None:
+        del Element.attrib["id"]
+
+
+def textContent(Element, context=None, **kwargs):
+    if context is not None:
+        return context.texts.textContent(Element)
+
+    # Without any children, that's just the text
+    if not len(Element) and Element.tag != "img":
+        return Element.text or ""
+
+    # Without any img elements, the text serialization is all we need
+    if next(Element.iter("img"), None) is None:
+        return etree.tostring(Element, encoding=unicode_type, method='text',
+                              with_tail=False)
+
+    # Otherwise, walk down to the img elements ourselves, replacing them (and
+    # whatever they contain) with their alt attribute, and serialize whatever
+    # doesn't contain any img element
+    paths = set()
+    for img in Element.iter("img"):
+        for ancestor in img.iterancestors():
+            if ancestor is Element or ancestor in paths:
+                break
+            paths.add(ancestor)
+    content = []
+    appendTextContent(Element, content, paths)
+    return "".join(content)
+
+
+def appendTextContent(Element, content, paths):
+    if Element.text is not None:
+        content.append(Element.text)
+    for child in Element:
+        if child.tag == "img":
+            # The alt and tail of an img directly following another img get
+            # lost, as they always have (they used to get moved onto the tail
+            # of the previous img, just before removing it).
+            previous = child.getprevious()
+            if previous is not None and previous.tag == "img":
+                continue
+            if child.get("alt") is not None:
+                content.append(child.get("alt"))
+        elif child in paths:
+            appendTextContent(child, content, paths)
+        elif not isinstance(child.tag, str_type):
+            # Comments and processing instructions only have their tail
+            pass
+        elif not len(child):
+            if child.text is not None:
+                content.append(child.text)
+        else:
+            content.append(etree.tostring(child, encoding=unicode_type,
+                                          method='text', with_tail=True))
+            continue
+        if child.tail is not None:
+            content.append(child.tail)
+
+
+def getElementById(base, id, context=None, **kwargs):
+    if context is not None:
+        return context.ids.get(id)
+    for element in base.iter(tag=etree.Element):
+        if element.get("id") == id:
+            return element
+    return None
 
 
 def escapeXPathString(string):
     return "concat('', '%s')" % string.replace("'", "', \"'\", '")
 
 
-def removeInteractiveContentChildren(element):
+def removeInteractiveContentChildren(element, **kwargs):
     # Iter over list of decendants of element
     for child in element.findall(".//*"):
         if isInteractiveContent(child):
             # Copy content, to prepare for the node being removed
-            copyContentForRemoval(child)
+            copyContentForRemoval(child, **kwargs)
             # Remove element
             child.getparent().remove(child)
 
@@ -202,7 +234,68 @@ def isInteractiveContent(element):
         return False
 
 
-def copyContentForRemoval(node, text=True, children=True, tail=True):
+class InstanceFinder(object):
+    """Find the elements that are instances of something, in document order,
+    along with whether they can be linked, in a single walk.
+
+    Each instance is listed as [element, blocked, parent]: blocked is true
+    when the element has an ancestor or descendant for which isBlocking is
+    true (such as a dfn or interactive content), and parent is the index of
+    the closest ancestor that is an instance too (or None), so that callers
+    can tell when an instance ends up in a link they made themselves."""
+
+    def __init__(self, isInstance, isBlocking):
+        self.isInstance = isInstance
+        self.isBlocking = isBlocking
+        self.instances = []
+        # For each open element, whether it blocks, whether anything within
+        # it does, and its index if it is an instance
+        self.stack = []
+        self.open_instances = []
+        self.blocking_ancestors = 0
+
+    def start(self, element):
+        blocking = self.isBlocking(element)
+        index = None
+        if self.isInstance(element):
+            index = len(self.instances)
+            parent = self.open_instances[-1] if self.open_instances else None
+            self.instances.append([element, self.blocking_ancestors > 0,
+                                   parent])
+            self.open_instances.append(index)
+        if blocking:
+            self.blocking_ancestors += 1
+        self.stack.append([blocking, False, index])
+
+    def end(self, element):
+        blocking, contains_blocking, index = self.stack.pop()
+        if blocking:
+            self.blocking_ancestors -= 1
+        if index is not None:
+            self.open_instances.pop()
+            if contains_blocking:
+                self.instances[index][1] = True
+        if self.stack and (blocking or contains_blocking):
+            self.stack[-1][1] = True
+
+    def find(self, ElementTree):
+        for action, element in etree.iterwalk(ElementTree,
+                                              events=("start", "end")):
+            if action == "start":
+                self.start(element)
+            else:
+                self.end(element)
+        return self.instances
+
+
+def copyContentForRemoval(node, text=True, children=True, tail=True,
+                          context=None, **kwargs):
+    # The text content of the parent is about to change, and the node is
+    # about to go
+    if context is not None:
+        context.texts.invalidate(node)
+        context.ids.discard(node, descendants=not children)
+        context.invalidateOutline(node)
     # Preserve the text, if it is an element
     if isinstance(node.tag, str_type) and node.text is not None and text:
         if node.getprevious() is not None:
@@ -232,41 +325,147 @@ def copyContentForRemoval(node, text=True, children=True, tail=True):
             else:
                 node.getparent().text += node.tail
 
-def replaceComment(ElementTree, comment, sub, **kwargs):
+class Directive(object):
+    """Where a comment directive is in the document: either a lone
+    <!--name--> comment (begin, with lone set), or a <!--begin-name--> and
+    <!--end-name--> pair (begin and end) around what replaced one before. A
+    begin- comment with no end- comment after it has no end, and its region
+    runs to the end of the document."""
+
+    def __init__(self, name, begin, end=None, lone=False):
+        self.name = name
+        self.begin = begin
+        self.end = end
+        self.lone = lone
+
+    def region(self):
+        """The nodes between the begin- and end- comments, leaving out those
+        inside any of the others."""
+        if self.end is not None:
+            for node in self.begin.itersiblings():
+                if node is self.end:
+                    return
+                yield node
+        else:
+            for node in self.begin.itersiblings():
+                yield node
+            for ancestor in self.begin.iterancestors():
+                # Leaving out what is around the root element
+                if ancestor.getparent() is None:
+                    break
+                for node in ancestor.itersiblings():
+                    yield node
+
+
+def findDirectives(ElementTree):
+    """Find every comment directive in one walk over the comments of the
+    document, returning the names of the comments, with those of
+    <!--begin-foo--> and <!--end-foo--> as "foo" too, and a dict of lists of
+    Directives, in document order, by name. Directives inside the region of
+    one with the same name, which replacing it removes, are left out."""
+    names = set()
+    directives = {}
+    # The begin- comments still waiting for their end- comment, by name
+    open_directives = {}
+    for comment in ElementTree.iter(etree.Comment):
+        name = (comment.text or "").strip(spaceCharacters)
+        names.add(name)
+        if name.startswith("end-"):
+            name = name[len("end-"):]
+            names.add(name)
+            if name in open_directives:
+                open_directives.pop(name).end = comment
+        elif name.startswith("begin-"):
+            name = name[len("begin-"):]
+            names.add(name)
+            if name not in open_directives:
+                open_directives[name] = Directive(name, comment)
+                directives.setdefault(name, []).append(open_directives[name])
+        elif name not in open_directives:
+            directives.setdefault(name, []).append(
+                Directive(name, comment, lone=True))
+    return names, directives
+
+
+def isAttached(node, root):
+    """Whether node is still in the document with the given root."""
+    while node is not None:
+        if node is root:
+            return True
+        node = node.getparent()
+    return False
+
+
+def getDirectives(ElementTree, name, context=None):
+    """The directives with the given name still in the document, as found
+    by the MarkerScan of the context (or, without one, by looking for them),
+    having made sure the begin- and end- comments of each have the same
+    parent."""
+    if context is not None:
+        directives = context.markers.directives.get(name, ())
+    else:
+        directives = findDirectives(ElementTree)[1].get(name, ())
+    root = ElementTree.getroot()
+    found = []
+    for directive in directives:
+        # Whatever replaced another directive, or got filtered out, might
+        # have taken this one with it
+        if not isAttached(directive.begin, root):
+            continue
+        if directive.end is not None and \
+           directive.end.getparent() is not directive.begin.getparent():
+            raise DifferentParentException("begin-%s and end-%s have "
+                                           "different parents"
+                                           % (name, name))
+        found.append(directive)
+    return found
+
+
+def replaceComment(ElementTree, comment, sub, context=None, **kwargs):
     begin_sub = "begin-%s" % comment
     end_sub = "end-%s" % comment
-    sub_parent = None
-    to_remove = set()
-    for node in ElementTree.iter():
-        if sub_parent is not None:
-            if node.tag is etree.Comment and \
-               node.text.strip(spaceCharacters) == end_sub:
-                if node.getparent() is not sub_parent:
-                    raise DifferentParentException("%s and %s have different parents" % begin_sub, end_sub)
-                sub_parent = None
-            else:
-                to_remove.add(node)
-        elif node.tag is etree.Comment:
-            if node.text.strip(spaceCharacters) == begin_sub:
-                sub_parent = node.getparent()
-                node.tail = None
-                node.addnext(deepcopy(sub))
-                indentNode(node.getnext(), 0, **kwargs)
-            elif node.text.strip(spaceCharacters) == comment:
-                node.addprevious(etree.Comment(begin_sub))
-                indentNode(node.getprevious(), 0, **kwargs)
-                node.addprevious(deepcopy(sub))
-                indentNode(node.getprevious(), 0, **kwargs)
-                node.addprevious(etree.Comment(end_sub))
-                indentNode(node.getprevious(), 0, **kwargs)
-                node.getprevious().tail = node.tail
-                to_remove.add(node)
+    to_remove = []
+    for directive in getDirectives(ElementTree, comment, context):
+        node = directive.begin
+        if not directive.lone:
+            if context is not None:
+                context.texts.invalidate(node.getparent())
+            to_remove.extend(directive.region())
+            node.tail = None
+            node.addnext(deepcopy(sub))
+            indentNode(node.getnext(), 0, **kwargs)
+            if context is not None:
+                context.ids.add(node.getnext())
+                context.invalidateOutline(node.getnext())
+        else:
+            if context is not None:
+                context.texts.invalidate(node.getparent())
+            node.addprevious(etree.Comment(begin_sub))
+            indentNode(node.getprevious(), 0, **kwargs)
+            directive.begin = node.getprevious()
+            node.addprevious(deepcopy(sub))
+            indentNode(node.getprevious(), 0, **kwargs)
+            if context is not None:
+                context.ids.add(node.getprevious())
+                context.invalidateOutline(node.getprevious())
+            node.addprevious(etree.Comment(end_sub))
+            indentNode(node.getprevious(), 0, **kwargs)
+            node.getprevious().tail = node.tail
+            directive.end = node.getprevious()
+            directive.lone = False
+            to_remove.append(node)
 
     for node in to_remove:
+        if context is not None:
+            context.ids.discard(node)
+            context.invalidateOutline(node)
         node.getparent().remove(node)
 
-def indentNode(node, indent=0, newline_char="\n", indent_char=" ", **kwargs):
+def indentNode(node, indent=0, newline_char="\n", indent_char=" ",
+               context=None, **kwargs):
     whitespace = newline_char + indent_char * indent
+    if context is not None:
+        context.texts.invalidate(node.getparent())
     if node.getprevious() is not None:
         if node.getprevious().tail is None:
             node.getprevious().tail = whitespace
@@ -278,6 +477,31 @@ def indentNode(node, indent=0, newline_char="\n", indent_char=" ", **kwargs):
         else:
             node.getparent().text += whitespace
 
+# Data files read so far, by absolute path, along with the mtime they had,
+# so that an anolis that stays running only reads them again once they
+# change
+json_files = {}
+
+def loadJSON(path):
+    """Load the given JSON data file, or return what it held the last time
+    if it hasn't changed since. The data is shared, so it mustn't be
+    changed."""
+    path = os.path.abspath(path)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        # Leave open() to raise the usual IOError
+        mtime = None
+    if path in json_files and json_files[path][0] == mtime:
+        return json_files[path][1]
+    fp = open(path, "r")
+    try:
+        data = json.load(fp)
+    finally:
+        fp.close()
+    json_files[path] = (mtime, data)
+    return data
+
 global reversed
 try:
     reversed
@@ -291,10 +515,248 @@ except NameError:
             yield x[i]
 
 
+class TextCache(object):
+    """Remember the text content of elements within a document.
+
+    Whatever changes the text content of an element (the text or tail of
+    anything within it, or the alt of an img within it) has to invalidate()
+    it, or any of its descendants, first."""
+
+    def __init__(self):
+        self.texts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def textContent(self, Element):
+        try:
+            text = self.texts[Element]
+        except KeyError:
+            self.misses += 1
+            text = self.texts[Element] = textContent(Element)
+        else:
+            self.hits += 1
+        return text
+
+    def invalidate(self, node):
+        """Forget the text content of node and all of its ancestors."""
+        if not self.texts:
+            return
+        self.texts.pop(node, None)
+        for ancestor in node.iterancestors():
+            self.texts.pop(ancestor, None)
+
+
+class IDRegistry(object):
+    """The elements in a document, by their id.
+
+    Ids should be given to (or taken from) elements in the document through
+    set() (or remove()), and elements with ids that get added to (or removed
+    from) the document should be add()ed (or discard()ed), so that this stays
+    accurate.
+
+    Ids elements no longer have don't get allocated again, as links made
+    before might still point to them."""
+
+    def __init__(self, ElementTree):
+        self.ElementTree = ElementTree
+        self._elements = None
+        # For each base id, how many of base-0, base-1, ... are known to be
+        # taken
+        self.suffixes = {}
+        # Ids that were in the document, but no longer are
+        self.released = set()
+
+    @property
+    def elements(self):
+        # Only look at the document once someone needs to
+        if self._elements is None:
+            self._elements = {}
+            root = self.ElementTree.getroot()
+            if root is not None:
+                self.add(root)
+        return self._elements
+
+    def get(self, id):
+        return self.elements.get(id)
+
+    def allocate(self, base, Element):
+        """Reserve the first of base, base-0, base-1, ... that isn't taken
+        for Element, and return it."""
+        elements = self.elements
+        released = self.released
+        id = base
+        if id in elements or id in released:
+            i = self.suffixes.get(base, 0)
+            id = "%s-%i" % (base, i)
+            while id in elements or id in released:
+                i += 1
+                id = "%s-%i" % (base, i)
+            self.suffixes[base] = i + 1
+        elements[id] = Element
+        return id
+
+    def set(self, Element, id):
+        old = Element.get("id")
+        if old is not None and self.elements.get(old) is Element:
+            self._free(old)
+        Element.set("id", id)
+        self.elements[id] = Element
+
+    def remove(self, Element):
+        id = Element.get("id")
+        if id is None:
+            return
+        if self.elements.get(id) is Element:
+            self._free(id)
+        del Element.attrib["id"]
+
+    def add(self, Element):
+        """Record the ids of Element and its descendants."""
+        for element in Element.iter(tag=etree.Element):
+            if element.get("id"):
+                self.elements[element.get("id")] = element
+
+    def invalidate(self):
+        """Forget every id, to look at the document afresh when next asked,
+        after something changed ids without saying."""
+        self._elements = None
+        self.suffixes = {}
+
+    def discard(self, Element, descendants=True):
+        """Forget the ids of Element and (unless told otherwise) its
+        descendants."""
+        if self._elements is None:
+            return
+        if descendants:
+            elements = Element.iter(tag=etree.Element)
+        else:
+            elements = (Element, )
+        for element in elements:
+            id = element.get("id")
+            if id and self._elements.get(id) is element:
+                self._free(id)
+
+    def _free(self, id):
+        del self._elements[id]
+        self.released.add(id)
+
+
+class MarkerScan(object):
+    """Whether a document has the comments, elements, attributes and ids
+    that processes look for to tell whether they have anything to do.
+
+    Each gets looked for, by lxml rather than by walking the document in
+    Python, the first time it is asked about; ids are looked up in the
+    IDRegistry of the context."""
+
+    def __init__(self, context):
+        self.context = context
+        self._comments = None
+        self._directives = None
+        self.elements = {}
+        self.attributes = {}
+
+    def _findDirectives(self):
+        self._comments, self._directives = \
+            findDirectives(self.context.ElementTree)
+
+    @property
+    def comments(self):
+        """The names of the comments in the document, with those of
+        <!--begin-foo--> and <!--end-foo--> as "foo"."""
+        if self._comments is None:
+            self._findDirectives()
+        return self._comments
+
+    @property
+    def directives(self):
+        """The comment directives in the document, as from findDirectives,
+        which processes replace through getDirectives."""
+        if self._directives is None:
+            self._findDirectives()
+        return self._directives
+
+    def hasElement(self, tag):
+        if tag not in self.elements:
+            self.elements[tag] = \
+                next(self.context.ElementTree.iter(tag), None) is not None
+        return self.elements[tag]
+
+    def hasAttribute(self, name):
+        if name not in self.attributes:
+            self.attributes[name] = \
+                bool(queries.xpath("count(//@%s)" % name)(
+                    self.context.ElementTree))
+        return self.attributes[name]
+
+    def has(self, triggers):
+        """Whether the document has any of the "comments", "elements",
+        "attributes" or "ids" in the dict of triggers."""
+        return (not self.comments.isdisjoint(triggers.get("comments", ())) or
+                any(self.hasElement(tag)
+                    for tag in triggers.get("elements", ())) or
+                any(self.hasAttribute(name)
+                    for name in triggers.get("attributes", ())) or
+                any(self.context.ids.get(id) is not None
+                    for id in triggers.get("ids", ())))
+
+
+class DocumentContext(object):
+    """What processes share about the document being processed.
+
+    There is one of these for each document, which goes away along with it,
+    taking everything it has found out about the document with it."""
+
+    def __init__(self, ElementTree):
+        self.ElementTree = ElementTree
+        self.ids = IDRegistry(ElementTree)
+        self.texts = TextCache()
+        # The outline, as built by outliner.getOutline, until something
+        # changes it
+        self.outline = None
+        # How many of each thing of note the processes have made
+        self.counts = dict.fromkeys(["dfns", "xrefs", "generated_ids", "toc_entries",
+                                     "references"], 0)
+        self._html4_doctype = None
+        self._markers = None
+
+    @property
+    def markers(self):
+        """The MarkerScan of the document, until something might have added
+        markers to it."""
+        if self._markers is None:
+            self._markers = MarkerScan(self)
+        return self._markers
+
+    def invalidateMarkers(self):
+        self._markers = None
+
+    @property
+    def html4_doctype(self):
+        """Whether the DOCTYPE of the document calls for HTML 4 ids."""
+        if self._html4_doctype is None:
+            self._html4_doctype = \
+                self.ElementTree.docinfo.public_id in html4_public_ids
+        return self._html4_doctype
+
+    def count(self, counter, n=1):
+        self.counts[counter] = self.counts.get(counter, 0) + n
+
+    def invalidateOutline(self, node=None):
+        """Forget the outline, if it could change by node being inserted or
+        removed, or, without a node, whatever the change was."""
+        if self.outline is None:
+            return
+        if node is None or node.tag in outline_content or \
+           next(node.iter(*outline_content), None) is not None:
+            self.outline = None
+
+
 class AnolisException(Exception):
     """Generic anolis error."""
     pass
 
 class DifferentParentException(AnolisException):
-    """begin-link and end-link do not have the same parent."""
+    """The begin- and end- comments of a directive do not have the same
+    parent."""
     pass
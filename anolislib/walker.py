@@ -0,0 +1,142 @@
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import unicode_literals
+
+from lxml import etree
+
+from anolislib import timing, utils
+
+# Whether lxml's iterwalk gives "comment" and "pi" events, which older
+# versions don't; walkNodes walks the tree itself with those
+try:
+    etree.iterwalk(etree.Element("walk"), events=("comment", "pi"))
+    iterwalk_nodes = True
+except (ValueError, TypeError):
+    iterwalk_nodes = False
+
+
+def walkNodes(ElementTree, events):
+    """Yield (event, node) pairs for the given events, as iterwalk does,
+    including for the comments and processing instructions around the
+    root element."""
+    if iterwalk_nodes:
+        for pair in etree.iterwalk(ElementTree, events=events):
+            yield pair
+        return
+    root = ElementTree.getroot()
+    top = list(reversed(list(root.itersiblings(preceding=True))))
+    top += [root] + list(root.itersiblings())
+    stack = [iter(top)]
+    parents = [None]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            parent = parents.pop()
+            if parent is not None and "end" in events:
+                yield "end", parent
+        elif node.tag is etree.Comment:
+            if "comment" in events:
+                yield "comment", node
+        elif node.tag is etree.PI:
+            if "pi" in events:
+                yield "pi", node
+        elif isinstance(node.tag, utils.str_type):
+            if "start" in events:
+                yield "start", node
+            stack.append(iter(node))
+            parents.append(node)
+
+
+class TreeWalk(object):
+    """Drive any number of registered handlers over a tree in one traversal.
+
+    Element handlers get called with the element on entering ("start") or
+    exiting ("end") it; comment handlers with each comment; text handlers
+    with every element, comment and processing instruction, on entering it,
+    for handlers that only care about text, tail and attributes."""
+
+    def __init__(self):
+        self.handlers = {"start": [], "end": [], "comment": [], "pi": []}
+
+    def register(self, start=None, end=None, text=None, comment=None):
+        if start is not None:
+            self.handlers["start"].append(start)
+        if end is not None:
+            self.handlers["end"].append(end)
+        if text is not None:
+            self.handlers["start"].append(text)
+            self.handlers["comment"].append(text)
+            self.handlers["pi"].append(text)
+        if comment is not None:
+            self.handlers["comment"].append(comment)
+
+    def walk(self, ElementTree):
+        events = tuple(event for event, handlers in self.handlers.items()
+                       if handlers)
+        if not events:
+            return
+        handlers = self.handlers
+        for action, node in walkNodes(ElementTree, events):
+            for handler in handlers[action]:
+                handler(node)
+
+
+class Visitor(object):
+    """A process, or the part of one, that can share a tree walk.
+
+    The walk may only do local changes (text, tail, attributes); anything
+    that moves nodes around belongs in finish(), which gets called, in
+    process order, once the walk is over."""
+
+    # Whether this needs the tree as left by the finish() of every earlier
+    # process, and so can't share their walk
+    barrier = False
+
+    # Full-tree walks the process does when run on its own
+    classic_walks = 1
+
+    def __init__(self, ElementTree, **kwargs):
+        self.ElementTree = ElementTree
+
+    def register(self, walk):
+        """Register handlers with the given TreeWalk."""
+        pass
+
+    def finish(self, **kwargs):
+        """Do whatever needs the walk to be over."""
+        pass
+
+
+def run(ElementTree, visitors, timings=None, **kwargs):
+    """Run the given Visitor classes over the tree in a single walk, timing
+    the walk and each finish() in timings, if given."""
+    names = [visitor.__module__.rpartition(".")[2] for visitor in visitors]
+    with timing.phase(timings, "walk (%s)" % ", ".join(names)):
+        instances = [visitor(ElementTree, **kwargs) for visitor in visitors]
+        walk = TreeWalk()
+        for instance in instances:
+            instance.register(walk)
+        walk.walk(ElementTree)
+    for name, instance in zip(names, instances):
+        with timing.phase(timings, name):
+            instance.finish(**kwargs)
@@ -0,0 +1,108 @@
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Keep documents up to date, rebuilding each whenever its input, or a data
+file its processes use in its xref directory, changes."""
+
+from __future__ import unicode_literals
+
+import os
+import time
+
+from anolislib import batch, registry
+
+
+def modified(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def sources(job):
+    entry, options = job
+    return [entry["input"]] + [
+        os.path.abspath(path)
+        for path in registry.dataFiles(options.get("processes", []),
+                                       options.get("xref", "data"))]
+
+
+def report(result, log, changed_at=None):
+    if result["error"] is not None:
+        log.write("Failed to build %s:\n%s\n" % (result["output"],
+                                                  result["error"]))
+    elif changed_at is None:
+        log.write("Built %s in %.3fs\n" % (result["output"],
+                                            result["seconds"]))
+    else:
+        log.write("Rebuilt %s in %.3fs, %.3fs after the change\n" % (
+            result["output"], result["seconds"], time.time() - changed_at))
+    log.flush()
+
+
+def build(work, log):
+    """Build the documents for the given (entry, options) pairs, as from
+    batch.readManifest, returning when each of their sources was modified,
+    for poll."""
+    seen = {}
+    for job in work:
+        for path in sources(job):
+            seen[path] = modified(path)
+        report(batch.processDocument(job), log)
+    return seen
+
+
+def poll(work, seen, log):
+    """Look for sources modified since they were last seen, rebuilding the
+    documents affected, and returning their results. A document that fails
+    to build keeps its previous output."""
+    changed = {}
+    for job in work:
+        for path in sources(job):
+            if path in changed:
+                continue
+            mtime = modified(path)
+            if mtime != seen.get(path):
+                changed[path] = seen[path] = mtime
+    results = []
+    if not changed:
+        return results
+    for job in work:
+        times = [changed[path] for path in sources(job) if path in changed]
+        if times:
+            # Data files that have gone say when the change was noticed
+            changed_at = max(mtime or time.time() for mtime in times)
+            result = batch.processDocument(job)
+            report(result, log, changed_at)
+            results.append(result)
+    return results
+
+
+def watch(work, log, interval=0.5):
+    """Build the documents for the given (entry, options) pairs, then poll
+    their sources every interval seconds, rebuilding those affected by any
+    change, until interrupted."""
+    seen = build(work, log)
+    try:
+        while True:
+            time.sleep(interval)
+            poll(work, seen, log)
+    except KeyboardInterrupt:
+        pass
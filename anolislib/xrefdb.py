@@ -0,0 +1,202 @@
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""The cross-spec definitions in the --xref directory (specs.json and the
+xrefs/*.json files it lists), compiled into an SQLite database alongside
+them, so that xspecxref can look terms up without parsing all of the JSON.
+
+anolis --compile-xrefs compiles the database. Once there is one, it gets
+compiled again whenever any of the JSON files is newer; until there is one,
+xspecxref reads the JSON files as before."""
+
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from anolislib import utils
+
+database_name = "xrefs.db"
+
+schema = """
+CREATE TABLE specs (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    definitions INTEGER NOT NULL
+);
+CREATE TABLE definitions (
+    spec TEXT NOT NULL,
+    term TEXT NOT NULL,
+    fragment TEXT NOT NULL,
+    PRIMARY KEY (spec, term)
+);
+"""
+
+# How much of the database SQLite may map into memory rather than read
+mmap_size = 256 * 1024 * 1024
+
+# Databases opened so far, by path, along with the mtime they had and the
+# process that opened them, as connections mustn't be shared across a fork
+databases = {}
+
+
+def modified(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def databasePath(xref):
+    return os.path.join(xref, database_name)
+
+
+def sources(xref):
+    """The JSON files the database for the given directory is compiled
+    from, as they are now."""
+    specs_path = os.path.join(xref, "specs.json")
+    specs = utils.loadJSON(specs_path)
+    return [specs_path] + [os.path.join(xref, "xrefs", file_name)
+                           for file_name in sorted(set(specs.values()))]
+
+
+def readJSON(path):
+    # Without keeping the data around, as utils.loadJSON would
+    fp = open(path, "r")
+    try:
+        return json.load(fp)
+    finally:
+        fp.close()
+
+
+def compileDatabase(xref):
+    """Compile the database for the given directory from its JSON files,
+    replacing any there was only once it is complete."""
+    specs = readJSON(os.path.join(xref, "specs.json"))
+    path = databasePath(xref)
+    temporary = "%s.%i.tmp" % (path, os.getpid())
+    try:
+        connection = sqlite3.connect(temporary)
+        try:
+            connection.executescript(schema)
+            for name, file_name in sorted(specs.items()):
+                dfn = readJSON(os.path.join(xref, "xrefs", file_name))
+                connection.execute("INSERT INTO specs VALUES (?, ?, ?)",
+                                   (name, dfn["url"],
+                                    len(dfn["definitions"])))
+                connection.executemany(
+                    "INSERT INTO definitions VALUES (?, ?, ?)",
+                    ((name, term, fragment)
+                     for term, fragment in dfn["definitions"].items()))
+            connection.commit()
+        finally:
+            connection.close()
+        os.rename(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def connect(xref):
+    """The Database for the given directory, compiled again first if any of
+    the JSON files is newer, or None if it has never been compiled, or can't
+    be now (in which case reading the JSON files will say what is wrong with
+    them)."""
+    path = databasePath(xref)
+    mtime = modified(path)
+    if mtime is None:
+        return None
+    try:
+        source_mtimes = [modified(source) for source in sources(xref)]
+        if None in source_mtimes:
+            return None
+        if max(source_mtimes) > mtime:
+            compileDatabase(xref)
+            mtime = modified(path)
+    except (IOError, OSError, ValueError, KeyError, sqlite3.Error):
+        return None
+
+    path = os.path.abspath(path)
+    if path in databases and databases[path][0] == mtime and \
+       databases[path][1] == os.getpid():
+        return databases[path][2]
+    database = Database(path)
+    databases[path] = (mtime, os.getpid(), database)
+    return database
+
+
+class Database(object):
+    """A compiled database, open for looking specs up in."""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA query_only = ON")
+        self.connection.execute("PRAGMA mmap_size = %i" % mmap_size)
+
+    def spec(self, name):
+        """The URL and definitions of the named spec, as xspecxref has them,
+        or None if there is no such spec."""
+        row = self.connection.execute(
+            "SELECT url, definitions FROM specs WHERE name = ?",
+            (name, )).fetchone()
+        if row is None:
+            return None
+        url, count = row
+        return {"url": url,
+                "values": Definitions(self.connection, name, count)}
+
+
+class Definitions(object):
+    """The definitions of a spec, by term, looked up in the database as they
+    are asked for."""
+
+    def __init__(self, connection, spec, count):
+        self.connection = connection
+        self.spec = spec
+        self.count = count
+        self.fragments = {}
+
+    def get(self, term, default=None):
+        if term not in self.fragments:
+            row = self.connection.execute(
+                "SELECT fragment FROM definitions WHERE spec = ? AND term = ?",
+                (self.spec, term)).fetchone()
+            self.fragments[term] = row and row[0]
+        if self.fragments[term] is None:
+            return default
+        return self.fragments[term]
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __getitem__(self, term):
+        fragment = self.get(term)
+        if fragment is None:
+            raise KeyError(term)
+        return fragment
+
+    def __len__(self):
+        return self.count
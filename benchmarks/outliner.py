@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Compare outliner.Outliner with the walk-everything implementation it
+replaced, both for speed and for identical outlines, on a synthetic spec."""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import random
+import sys
+import timeit
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from anolislib import utils
+from anolislib.processes import outliner
+
+
+class ClassicOutliner(outliner.Outliner):
+    """The previous implementation of outliner.Outliner, which gets every
+    event inside headings and goes through the elif chain for each."""
+
+    def build(self, **kwargs):
+        for action, element in etree.iterwalk(self.ElementTree,
+                                              events=("start", "end")):
+            if action == "end" and self.stack and self.stack[-1] == element:
+                self.stack.pop()
+            elif self.stack and self.stack[-1].tag in utils.heading_content:
+                pass
+            elif action == "start" and \
+                 (element.tag in utils.sectioning_content or \
+                  element.tag in utils.sectioning_root):
+                if self.current_outlinee is not None:
+                    self.stack.append(self.current_outlinee)
+                self.current_outlinee = element
+                self.current_section = ClassicSection()
+                self.outlines[self.current_outlinee] = [self.current_section]
+            elif action == "end" and \
+                 element.tag in utils.sectioning_content and self.stack:
+                self.current_outlinee = self.stack.pop()
+                self.current_section = self.outlines[self.current_outlinee][-1]
+                self.current_section += self.outlines[element]
+            elif action == "end" and element.tag in utils.sectioning_root and \
+                 self.stack:
+                self.current_outlinee = self.stack.pop()
+                self.current_section = self.outlines[self.current_outlinee][-1]
+                while self.current_section:
+                    self.current_section = self.current_section[-1]
+            elif action == "end" and \
+                 (element.tag in utils.sectioning_content or \
+                  element.tag in utils.sectioning_root):
+                self.current_section = self.outlines[self.current_outlinee][0]
+                break
+            elif self.current_outlinee is None:
+                pass
+            elif action == "start" and element.tag in utils.heading_content:
+                rank = self.ranks[element] = self._rank(element)
+                if self.current_section.header is None:
+                    self.current_section.header = element
+                elif rank >= self._headerRank(
+                        self.outlines[self.current_outlinee][-1].header):
+                    self.current_section = ClassicSection()
+                    self.outlines[self.current_outlinee] \
+                        .append(self.current_section)
+                    self.current_section.header = element
+                else:
+                    candidate_section = self.current_section
+                    while True:
+                        if rank < self._headerRank(candidate_section.header):
+                            self.current_section = ClassicSection()
+                            candidate_section.append(self.current_section)
+                            self.current_section.header = element
+                            break
+                        candidate_section = candidate_section.parent
+                self.stack.append(element)
+        try:
+            return self.outlines[self.current_outlinee]
+        except KeyError:
+            return None
+
+
+class ClassicSection(list):
+    """The previous outliner.section, with a __dict__ for each section."""
+
+    header = None
+
+    def append(self, child):
+        list.append(self, child)
+        child.parent = self
+
+
+def makeSpec(sections, seed=0):
+    """A spec-like document with the given number of sections, with
+    headings, hgroups, nested sectioning elements and plenty of inline
+    markup inside headings and paragraphs."""
+    random.seed(seed)
+    parts = ["<!DOCTYPE html><title>Spec</title><h1>Spec</h1>"]
+    depth = 2
+    open_sections = []
+    for i in range(sections):
+        depth = max(2, min(6, depth + random.choice((-1, 0, 0, 1))))
+        heading = ("<h%i>Section <code>%i</code> about <dfn>term %i</dfn> "
+                   "and <span>more <em>markup</em></span></h%i>"
+                   % (depth, i, i, depth))
+        kind = random.random()
+        if kind < 0.1:
+            parts.append("<section>")
+            open_sections.append("</section>")
+        elif kind < 0.15 and open_sections:
+            parts.append(open_sections.pop())
+        if kind > 0.95:
+            heading = "<hgroup>%s<h6>Subtitle</h6></hgroup>" % heading
+        parts.append(heading)
+        parts.append("<p>Some <a href='#x'>text</a> with <code>code</code>."
+                     "<div class=example><pre>example</pre></div>" * 3)
+    parts.extend(reversed(open_sections))
+    return etree.HTML("".join(parts)).getroottree()
+
+
+def shape(outline):
+    """The headings and nesting of an outline, to compare outlines by."""
+    return [(section.header, shape(section)) for section in outline or []]
+
+
+def main():
+    tree = makeSpec(5000)
+    assert shape(outliner.Outliner(tree).build()) == \
+        shape(ClassicOutliner(tree).build())
+
+    for name, implementation in (("classic", ClassicOutliner),
+                                 ("pruning", outliner.Outliner)):
+        seconds = min(timeit.repeat(lambda: implementation(tree).build(),
+                                    number=5, repeat=3)) / 5
+        print("%-8s %8.2f ms" % (name, seconds * 1e3))
+
+
+if __name__ == "__main__":
+    main()
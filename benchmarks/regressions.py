@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Check for performance regressions against a baseline written by
+suite.py, exiting with status 1 if any phase got slower by more than the
+threshold at any size.
+
+The current run uses the baseline's sizes and settings. Times on both sides
+are measured in how many suite.calibrationLoops the machine could have run
+in the time, just before, so the baseline can come from a faster or slower
+machine, or from the same one when it was less busy. Processes
+are timed on their own (unless the baseline shared walks between them), so
+a regression is attributed to the process responsible.
+
+Should anything look slower, everything gets run again, up to --attempts
+times in all, taking the best time for each phase, so that only phases that
+are slower every time count as regressions."""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+import suite
+
+default_baseline = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def compare(baseline, current, threshold=25.0, minimum=0.001):
+    """Compare each phase at each size in the current results with the
+    baseline, returning a (sections, phase, baseline seconds, current
+    seconds, change in percent, regressed) tuple for each, with both in
+    seconds on the current machine at its fastest. Phases taking under
+    minimum seconds are too noisy to count as regressions."""
+    scale = current["calibration_seconds"]
+    baseline_results = dict((result["sections"], result)
+                            for result in baseline["results"])
+    comparisons = []
+    for result in current["results"]:
+        base = baseline_results[result["sections"]]
+        for name in result["phase_names"]:
+            if name not in base["calibrated"]:
+                continue
+            before = base["calibrated"][name] * scale
+            after = result["calibrated"][name] * scale
+            change = (after / before - 1) * 100 if before else 0.0
+            regressed = change > threshold and max(before, after) >= minimum
+            comparisons.append((result["sections"], name, before, after,
+                                change, regressed))
+    return comparisons
+
+
+def merge(current, rerun):
+    """Keep the best calibrated time for each phase from a rerun."""
+    results = dict((result["sections"], result)
+                   for result in rerun["results"])
+    for result in current["results"]:
+        calibrated = results[result["sections"]]["calibrated"]
+        for name, units in calibrated.items():
+            result["calibrated"][name] = min(result["calibrated"][name], units)
+    current["calibration_seconds"] = min(current["calibration_seconds"],
+                                         rerun["calibration_seconds"])
+
+
+def report(comparisons, output):
+    output.write("%-8s %-24s %12s %12s %9s\n" % ("sections", "phase",
+                                                 "baseline", "current",
+                                                 "change"))
+    for sections, name, before, after, change, regressed in comparisons:
+        output.write("%-8i %-24s %9.2f ms %9.2f ms %+8.1f%%%s\n" % (
+            sections, name, before * 1e3, after * 1e3, change,
+            "  REGRESSED" if regressed else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--baseline", type=str, default=default_baseline,
+                        help="Baseline to compare with. Default: "
+                             "benchmarks/baseline.json")
+    parser.add_argument("--threshold", type=float, default=25.0,
+                        help="Percentage by which a phase may get slower "
+                             "before it counts as a regression. Default: 25")
+    parser.add_argument("--minimum", type=float, default=1.0,
+                        help="Milliseconds a phase has to take for it to "
+                             "count as a regression. Default: 1")
+    parser.add_argument("--attempts", type=int, default=3,
+                        help="Times to run everything, if there look to be "
+                             "regressions, before giving up. Default: 3")
+    parser.add_argument("--output", type=str,
+                        help="Write the current results to this file as JSON")
+    parser.add_argument("--update", action="store_true",
+                        help="Replace the baseline with the current results, "
+                             "instead of comparing with it")
+    args = parser.parse_args()
+
+    baseline = json.load(open(args.baseline))
+
+    def benchmark():
+        return suite.run([result["sections"]
+                          for result in baseline["results"]],
+                         repeat=baseline["repeat"],
+                         processes=baseline["processes"],
+                         parsers=baseline["parsers"],
+                         serializers=baseline["serializers"],
+                         fuse_walks=baseline["fuse_walks"])
+
+    current = benchmark()
+    if args.update:
+        suite.write(current, args.baseline)
+        return
+
+    for attempt in range(1, args.attempts + 1):
+        if attempt > 1:
+            sys.stderr.write("Running again to confirm regressions\n")
+            merge(current, benchmark())
+        comparisons = compare(baseline, current, args.threshold,
+                              args.minimum / 1e3)
+        if not [comparison for comparison in comparisons
+                if comparison[-1]]:
+            break
+
+    if args.output:
+        suite.write(current, args.output)
+    report(comparisons, sys.stdout)
+    regressions = [comparison for comparison in comparisons
+                   if comparison[-1]]
+    if regressions:
+        print("\n%i regressions of more than %g%%" % (len(regressions),
+                                                     args.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
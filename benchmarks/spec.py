@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Generate synthetic specs, with the data files they need, at any scale.
+
+A spec has the given number of sections, nested to varying depths, some in
+<section> elements, each with headings, dfns, instances of terms defined
+anywhere in the spec, normative and informative references, cross-spec
+references, examples, comments and inline markup, along with a table of
+contents, a references section and an index of terms. Its data directory
+has the references and the other specs' definitions it uses."""
+
+from __future__ import unicode_literals
+
+import json
+import os
+import random
+
+# The other specs cross-spec references go to
+external_specs = ["alpha", "beta", "gamma", "delta"]
+
+
+def term(i):
+    return "term %i" % i
+
+
+def externalTerm(spec, i):
+    return "%s term %i" % (spec, i)
+
+
+def makeSpec(sections, dfns=4, references=2, cross_refs=2, seed=0):
+    """The source of a spec with the given number of sections and, in each,
+    the given number of dfns, references and cross-spec references, as
+    bytes. The same arguments always give the same spec."""
+    rng = random.Random(seed)
+    total_dfns = sections * dfns
+    parts = ["<!DOCTYPE html>\n<html lang=en>\n<title>Synthetic Spec</title>\n"
+             "<h1>Synthetic Spec</h1>\n<h2 class=no-num>Table of contents</h2>"
+             "\n<!--toc-->\n"]
+    depth = 2
+    open_sections = []
+    dfn = 0
+    for i in range(sections):
+        depth = max(2, min(6, depth + rng.choice((-1, 0, 0, 1))))
+        kind = rng.random()
+        if kind < 0.1:
+            parts.append("<section>\n")
+            open_sections.append("</section>\n")
+        elif kind < 0.15 and open_sections:
+            parts.append(open_sections.pop())
+        parts.append("<h%i>Section %i on <code>%s</code></h%i>\n"
+                     % (depth, i, term(rng.randrange(total_dfns)), depth))
+        for j in range(dfns):
+            instances = ", ".join("<span>%s</span>"
+                                  % term(rng.randrange(total_dfns))
+                                  for k in range(3))
+            parts.append("<p>A <dfn>%s</dfn> is <em>used</em> with %s.\n"
+                         % (term(dfn), instances))
+            dfn += 1
+        for j in range(references):
+            parts.append("<p>As <span data-anolis-ref%s>REF%i</span> says, "
+                         "<i>see there</i>.\n"
+                         % (" class=informative" if rng.random() < 0.3
+                            else "", rng.randrange(sections)))
+        for j in range(cross_refs):
+            spec = rng.choice(external_specs)
+            parts.append("<p>Use the <span data-anolis-spec=%s>%s</span> "
+                         "from elsewhere.\n"
+                         % (spec, externalTerm(spec, rng.randrange(sections))))
+        parts.append("<!-- Section %i ends here -->\n<div class=example><pre>"
+                     "&lt;p>%s&lt;/p></pre></div>\n" % (i, term(i)))
+    parts.extend(reversed(open_sections))
+    parts.append("<h2 class=no-num>References</h2>\n"
+                 "<div id=anolis-references></div>\n"
+                 "<h2 class=no-num>Index</h2>\n<!--index-terms-->\n")
+    return "".join(parts).encode("utf-8")
+
+
+def writeData(directory, sections):
+    """Write the data files a spec with the given number of sections uses
+    into directory, as the --xref directory for it."""
+    xrefs = os.path.join(directory, "xrefs")
+    if not os.path.isdir(xrefs):
+        os.makedirs(xrefs)
+
+    references = dict(("REF%i" % i, {"title": "Reference %i" % i,
+                                     "href": "http://example.org/ref%i" % i,
+                                     "authors": ["A. Author", "B. Author"],
+                                     "publisher": "Example"})
+                      for i in range(sections))
+    specs = dict((spec, spec + ".json") for spec in external_specs)
+    files = {"references.json": references, "specs.json": specs}
+    for spec in external_specs:
+        definitions = dict((externalTerm(spec, i), "%s-term-%i" % (spec, i))
+                           for i in range(sections))
+        files[os.path.join("xrefs", spec + ".json")] = {
+            "url": "http://example.org/%s/#" % spec,
+            "definitions": definitions}
+
+    for name, data in files.items():
+        fp = open(os.path.join(directory, name), "w")
+        fp.write(json.dumps(data, sort_keys=True, indent=2))
+        fp.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Time each parser, process and serializer on synthetic specs of growing
+size, as made by spec.makeSpec, and write the results out as JSON.
+
+Next to the time each phase takes at each size, the table printed at the
+end has the order of growth from the smallest size to the largest: about 1
+for a phase that scales linearly with the spec, and 2 for one that scales
+quadratically."""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+from io import BytesIO
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from anolislib import generator, timing
+import spec
+
+default_processes = ["filter", "sub", "toc", "xref", "xspecxref", "refs",
+                     "terms", "annotate"]
+
+
+def calibrationLoop():
+    """Plain Python work, of the sort processes do, to measure how fast the
+    machine is with."""
+    counts = {}
+    for i in range(100000):
+        key = "term %i" % (i % 1000)
+        counts[key] = counts.get(key, 0) + 1
+    return sorted(counts, key=lambda key: key.lower())
+
+
+def calibrate(repeat=5):
+    """How long calibrationLoop takes, at best, in seconds."""
+    return min(timeit.repeat(calibrationLoop, number=1, repeat=repeat))
+
+
+def timePhases(source, xref, processes, parsers, serializers,
+               fuse_walks=False):
+    """Parse the source with each parser, process the tree from the first
+    and serialize the result with each serializer, returning the
+    timing.Timings for it all."""
+    timings = timing.Timings()
+    tree = None
+    for parser in parsers:
+        with timings.phase("parse (%s)" % parser):
+            parsed = generator.parse(BytesIO(source), parser)
+        if tree is None:
+            tree = parsed
+    generator.process(tree, processes, xref=xref, fuse_walks=fuse_walks,
+                      timings=timings)
+    for serializer in serializers:
+        with timings.phase("serialize (%s)" % serializer):
+            generator.toString(tree, serializer=serializer)
+    return timings
+
+
+def benchmark(sections, repeat=3, **kwargs):
+    """The fastest time for each phase, out of repeat runs, on a spec with
+    the given number of sections, along with what the processes made.
+
+    Each run is preceded by timing calibrationLoop, and "calibrated" has
+    the fewest calibrationLoops each phase took in any run, going by the
+    speed of the machine just before it, to compare between machines or
+    with the machine itself at a busier time."""
+    source = spec.makeSpec(sections)
+    xref = tempfile.mkdtemp()
+    try:
+        spec.writeData(xref, sections)
+        runs = []
+        for i in range(repeat):
+            calibration = calibrate(3)
+            runs.append((calibration, timePhases(source, xref, **kwargs)))
+    finally:
+        shutil.rmtree(xref)
+
+    phases = {}
+    calibrated = {}
+    for calibration, run in runs:
+        for phase in run.phases:
+            name = phase["name"]
+            phases[name] = min(phases.get(name, phase["seconds"]),
+                               phase["seconds"])
+            calibrated[name] = min(calibrated.get(name, phase["seconds"] /
+                                                        calibration),
+                                   phase["seconds"] / calibration)
+    timings = runs[0][1]
+    return {"sections": sections,
+            "bytes": len(source),
+            "phases": phases,
+            "calibrated": calibrated,
+            "phase_names": [phase["name"] for phase in timings.phases],
+            "counts": timings.counts,
+            "walks": timings.walks,
+            # By the last run, every query has been compiled before
+            "queries": runs[-1][1].queries,
+            "peak_memory_kib": timing.peakMemory()}
+
+
+def growth(results, name):
+    """The order of growth of a phase from the smallest spec to the largest,
+    if there are two sizes to go by."""
+    first, last = results[0], results[-1]
+    if first["sections"] == last["sections"] or \
+       not first["phases"][name] or not last["phases"][name]:
+        return None
+    return (math.log(last["phases"][name] / first["phases"][name]) /
+            math.log(float(last["sections"]) / first["sections"]))
+
+
+def report(results, output):
+    """Write a table with the time each phase took at each size in ms, and
+    its order of growth."""
+    output.write("%-24s" % "phase" +
+                 "".join("%12s" % ("%i sect." % result["sections"])
+                         for result in results) + "%8s\n" % "order")
+    for name in results[0]["phase_names"]:
+        order = growth(results, name)
+        output.write("%-24s" % name +
+                     "".join("%12.2f" % (result["phases"][name] * 1e3)
+                             for result in results) +
+                     ("%8.2f\n" % order if order is not None else "%8s\n" % "-"))
+
+
+def run(sizes, repeat=3, processes=default_processes,
+        parsers=["html5lib", "lxml.html"],
+        serializers=["html5lib", "lxml.html"], fuse_walks=False):
+    """Benchmark specs with each of the given numbers of sections, returning
+    the results, along with the settings used and the best time for
+    calibrationLoop, as written out by --output."""
+    results = []
+    for sections in sorted(sizes):
+        sys.stderr.write("Timing a spec with %i sections\n" % sections)
+        results.append(benchmark(sections, repeat=repeat,
+                                 processes=processes, parsers=parsers,
+                                 serializers=serializers,
+                                 fuse_walks=fuse_walks))
+    return {"python": platform.python_version(),
+            "processes": processes,
+            "parsers": parsers,
+            "serializers": serializers,
+            "repeat": repeat,
+            "fuse_walks": fuse_walks,
+            "calibration_seconds": calibrate(),
+            "results": results}
+
+
+def write(results, path):
+    fp = open(path, "w")
+    fp.write(json.dumps(results, sort_keys=True, indent=2,
+                        separators=(',', ': ')) + "\n")
+    fp.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=str, default="50,200,800",
+                        help="Comma separated numbers of sections in the specs "
+                             "to time. Default: 50,200,800")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Times to process each spec, taking the fastest "
+                             "time for each phase. Default: 3")
+    parser.add_argument("--enable", type=str, action="append",
+                        dest="processes",
+                        help="Time the given process, instead of the default "
+                             "ones; may be given more than once")
+    parser.add_argument("--parser", type=str, action="append", dest="parsers",
+                        choices=("html5lib", "lxml.html"),
+                        help="Time the given parser; the first one given "
+                             "makes the tree to process. Default: both")
+    parser.add_argument("--serializer", type=str, action="append",
+                        dest="serializers", choices=("html5lib", "lxml.html"),
+                        help="Time the given serializer. Default: both")
+    parser.add_argument("--fuse-walks", action="store_true",
+                        help="Let processes share tree walks, as anolis does, "
+                             "instead of timing each on its own")
+    parser.add_argument("--output", type=str,
+                        help="Write the results to this file as JSON")
+    args = parser.parse_args()
+
+    results = run([int(size) for size in args.sizes.split(",")],
+                  repeat=args.repeat,
+                  processes=args.processes or default_processes,
+                  parsers=args.parsers or ["html5lib", "lxml.html"],
+                  serializers=args.serializers or ["html5lib", "lxml.html"],
+                  fuse_walks=args.fuse_walks)
+    report(results["results"], sys.stdout)
+    if args.output:
+        write(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Copyright (c) 2008 Geoffrey Sneddon
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Compare utils.textContent with the deepcopy-based implementation it
+replaced, both for speed and for identical results."""
+
+from __future__ import print_function, unicode_literals
+
+from copy import deepcopy
+import os
+import sys
+import timeit
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from anolislib import utils
+
+
+def copyTextContent(Element):
+    """The previous implementation of utils.textContent."""
+    Element = deepcopy(Element)
+    to_remove = set()
+    for child in Element.iter(tag="img"):
+        if child.get("alt") is not None:
+            if child.getprevious() is not None:
+                if child.getprevious().tail is None:
+                    child.getprevious().tail = child.get("alt")
+                else:
+                    child.getprevious().tail += child.get("alt")
+            else:
+                if child.getparent().text is None:
+                    child.getparent().text = child.get("alt")
+                else:
+                    child.getparent().text += child.get("alt")
+        if child.tail is not None:
+            if child.getprevious() is not None:
+                if child.getprevious().tail is None:
+                    child.getprevious().tail = child.tail
+                else:
+                    child.getprevious().tail += child.tail
+            else:
+                if child.getparent().text is None:
+                    child.getparent().text = child.tail
+                else:
+                    child.getparent().text += child.tail
+        to_remove.add(child)
+    for node in to_remove:
+        node.getparent().remove(node)
+    return etree.tostring(Element, encoding=utils.unicode_type,
+                          method='text', with_tail=False)
+
+
+def makeElements(count):
+    """A mix of the elements textContent typically gets called on."""
+    section = etree.fromstring(
+        '<div><h2>Some <dfn>heading</dfn> <code>text</code></h2>'
+        '<p>A <span title="x">paragraph</span> <!--comment-->with '
+        '<a href="#foo"><code>code</code> and <em>emphasis</em></a>'
+        '<img alt="an image"/> and <img/> images <?pi data?>tail.</p>'
+        '<p>Plain <span>span</span> text.</p></div>')
+    root = etree.Element("body")
+    for i in range(count):
+        root.append(deepcopy(section))
+    return [element for element in root.iter(tag=etree.Element)
+            if element.tag != "img"]
+
+
+def main():
+    elements = makeElements(200)
+    byTag = {}
+    for element in elements:
+        assert utils.textContent(element) == copyTextContent(element), \
+            etree.tostring(element)
+        byTag.setdefault(element.tag, []).append(element)
+
+    print("%-6s %12s %12s" % ("", "deepcopy", "streaming"))
+    for tag, tagElements in sorted(byTag.items()):
+        times = []
+        for function in (copyTextContent, utils.textContent):
+            seconds = min(timeit.repeat(lambda: [function(element)
+                                                 for element in tagElements],
+                                        number=5, repeat=3))
+            times.append(seconds / (5 * len(tagElements)) * 1e6)
+        print("%-6s %9.2f us %9.2f us" % (tag, times[0], times[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -19,77 +19,792 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+"""Run the golden tests: process each tests/*.src.html, with the options in
+the .options file next to it, and compare the result with the .html file.
+
+The tests get run up front, across a pool of worker processes, and the
+slowest of them are listed at the end. With --scale, each test's input also
+gets processed with its content repeated that many times, failing should
+that take more than linearly longer."""
+
+import argparse
+from copy import deepcopy
 import glob
 import json
+import logging
+import math
+import multiprocessing
 import StringIO
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import types
 import unittest
 
 import html5lib
 from html5lib import treebuilders
+import lxml.html
 from lxml import etree
 
-from anolislib import generator
+from anolislib import (batch, generator, registry, utils, walker, watch,
+                       xrefdb)
+
+# The result of running each test, by file name and scale
+results = {}
 
 
 def get_files(*args):
     return glob.glob(os.path.join(*args))
 
 
+def get_options(file_name):
+    assert file_name.endswith(".src.html")
+    base_path = file_name[:-len(".src.html")]
+
+    kwargs = {}
+    try:
+        options_file_name = base_path + ".options"
+        with open(options_file_name, "r") as options_file:
+            kwargs = json.load(options_file)
+    except IOError:
+        pass
+
+    default_processes = ["filter", "sub", "toc", "xref", "annotate"]
+    new_processes = kwargs.get("processes", [])
+    assert not set(default_processes) & set(new_processes)
+    kwargs["processes"] = default_processes + new_processes
+
+    # Sort attributes alphabetically by default.
+    kwargs["alphabetical_attributes"] = True
+    return kwargs
+
+
+def enlarge(source, scale):
+    """The given document with the content of its body repeated scale times.
+    Only the first copy keeps its comments, as otherwise each copy's <!--toc-->
+    and the like would get the whole, ever larger, document's worth."""
+    tree = generator.parse(StringIO.StringIO(source))
+    body = tree.getroot().find("body")
+    original = deepcopy(body)
+    for comment in list(original.iter(etree.Comment)):
+        utils.copyContentForRemoval(comment)
+        comment.getparent().remove(comment)
+    for i in range(scale - 1):
+        content = deepcopy(original)
+        if len(body):
+            body[-1].tail = (body[-1].tail or "") + (content.text or "")
+        else:
+            body.text = (body.text or "") + (content.text or "")
+        body.extend(content)
+    return lxml.html.tostring(tree, encoding="utf-8")
+
+
+def run_test(job):
+    """Process a test's input, enlarged to the given scale, the given number
+    of times, returning the output and the shortest time it took, or what
+    went wrong."""
+    file_name, scale, repeat = job
+    result = {"output": None, "seconds": None, "error": None,
+              "failure": False}
+    try:
+        kwargs = get_options(file_name)
+
+        # Get the input
+        input = open(file_name, "rb")
+        source = input.read()
+        input.close()
+        if scale > 1:
+            source = enlarge(source, scale)
+            # As every dfn now is
+            kwargs["allow_duplicate_dfns"] = True
+
+        for i in range(repeat):
+            start = time.time()
+            output = StringIO.StringIO()
+            tree = generator.fromFile(StringIO.StringIO(source), **kwargs)
+            generator.toFile(tree, output, **kwargs)
+            seconds = time.time() - start
+            if result["seconds"] is None or seconds < result["seconds"]:
+                result["seconds"] = seconds
+        result["output"] = output.getvalue()
+    except IOError as err:
+        result["error"] = "%s" % err
+        result["failure"] = True
+    except Exception:
+        result["error"] = traceback.format_exc()
+    return result
+
+
+def get_expected(file_name):
+    expectedfp = open(file_name[:-len(".src.html")] + ".html", "rb")
+    try:
+        return expectedfp.read()
+    finally:
+        expectedfp.close()
+
+
+def get_result(file_name, scale=1, repeat=1):
+    if (file_name, scale) not in results:
+        results[file_name, scale] = run_test((file_name, scale, repeat))
+    return results[file_name, scale]
+
+
 class TestCase(unittest.TestCase):
+
+    def check_result(self, result):
+        if result["failure"]:
+            self.fail(result["error"])
+        elif result["error"] is not None:
+            raise ProcessingError(result["error"])
+
+
+class ProcessingError(Exception):
     pass
 
 
-def buildTestSuite():
+def buildTestSuite(scale=1, repeat=1, max_order=1.5):
     for file_name in get_files("tests", "*.src.html"):
 
         def testFunc(self, file_name=file_name):
-            assert file_name.endswith(".src.html")
-            base_path = file_name[:-len(".src.html")]
+            result = get_result(file_name, repeat=repeat)
+            self.check_result(result)
 
-            kwargs = {}
+            # Get the expected result
             try:
-                options_file_name = base_path + ".options"
-                with open(options_file_name, "r") as options_file:
-                    kwargs = json.load(options_file)
-            except IOError:
-                pass
+                expected = get_expected(file_name)
+            except IOError as err:
+                self.fail(err)
+
+            # Run the test
+            self.assertEquals(result["output"], expected)
+
+        setattr(TestCase, "test_%s" % (file_name), testFunc)
+
+        if scale <= 1:
+            continue
+
+        def testScale(self, file_name=file_name):
+            result = get_result(file_name, repeat=repeat)
+            scaled = get_result(file_name, scale, repeat)
+            self.check_result(result)
+            self.check_result(scaled)
+            order = (math.log(scaled["seconds"] / result["seconds"]) /
+                     math.log(scale))
+            self.assertTrue(order <= max_order,
+                            "%.3fs at %i times the size, against %.3fs, "
+                            "grows with the size to the power of %.2f" %
+                            (scaled["seconds"], scale, result["seconds"],
+                             order))
+
+        setattr(TestCase, "test_scale_%s" % (file_name), testScale)
+
+
+class FusedWalkTestCase(unittest.TestCase):
+    """Processes sharing a walk give the same output as running one after
+    the other."""
+
+    def process(self, source, processes, **kwargs):
+        tree = generator.fromFile(StringIO.StringIO(source),
+                                  processes=processes,
+                                  publication_date="05 Mar 2009", **kwargs)
+        return generator.toString(tree)
 
-            default_processes = ["filter", "sub", "toc", "xref", "annotate"]
-            new_processes = kwargs.get("processes", [])
-            assert not set(default_processes) & set(new_processes)
-            kwargs["processes"] = default_processes + new_processes
+    def check_fused(self, source, processes, expected):
+        self.assertEquals(self.process(source, processes), expected)
+        self.assertEquals(self.process(source, processes, fuse_walks=False),
+                          expected)
 
-            # Sort attributes alphabetically by default.
-            kwargs["alphabetical_attributes"] = True
+    def test_substitution_after_xref(self):
+        self.check_fused(b"<!doctype html><p><dfn>2009</dfn> "
+                         b"<span>[YEAR]</span>",
+                         ["xref", "sub"],
+                         b"<!DOCTYPE html><meta charset=utf-8><p>"
+                         b"<dfn id=2009>2009</dfn> <span>2009</span>")
 
+    def test_substitution_last(self):
+        self.check_fused(b"<!doctype html><title>Foo</title><p><dfn>Foo</dfn> "
+                         b"<span>[TITLE]</span>",
+                         ["filter", "toc", "xref", "annotate", "sub"],
+                         b"<!DOCTYPE html><meta charset=utf-8><title>Foo"
+                         b"</title><p><dfn id=foo>Foo</dfn> <span>Foo</span>")
+
+
+class GenerateIDTestCase(unittest.TestCase):
+    """Ids generated without a context, as from outside the processes."""
+
+    def test_ids_set_directly(self):
+        tree = generator.fromFile(StringIO.StringIO(
+            b"<!doctype html><p>Foo<p>Foo<p>Bar"), processes=[])
+        first, second, other = tree.getroot().find("body")
+        self.assertEquals(utils.generateID(first), "foo")
+        other.set("id", "foo-0")
+        self.assertEquals(utils.generateID(second), "foo")
+        second.set("id", "foo")
+        self.assertEquals(utils.generateID(first), "foo-1")
+
+
+def countElements(ElementTree, **kwargs):
+    """Add an element saying how many elements there were."""
+    body = ElementTree.getroot().find("body")
+    count = len(list(ElementTree.getroot().iter()))
+    etree.SubElement(body, "span").text = "%i" % count
+
+
+class CountingVisitor(walker.Visitor):
+
+    def __init__(self, ElementTree, **kwargs):
+        walker.Visitor.__init__(self, ElementTree)
+        self.count = 0
+
+    def register(self, walk):
+        walk.register(start=self.collect)
+
+    def collect(self, element):
+        self.count += 1
+
+    def finish(self, **kwargs):
+        body = self.ElementTree.getroot().find("body")
+        etree.SubElement(body, "span").text = "%i" % self.count
+
+
+class PipelineOrderTestCase(unittest.TestCase):
+    """Processes run through registry.pipeline give the same output as
+    running them one after the other in the order given."""
+
+    options = {"publication_date": "05 Mar 2009", "filter": ".dropped"}
+
+    def in_order(self, source, processes):
+        tree = generator.parse(StringIO.StringIO(source))
+        context = utils.DocumentContext(tree)
+        for name in processes:
+            registry.get(name).function(tree, context=context,
+                                        **self.options)
+        return generator.toString(tree, **self.options)
+
+    def check_order(self, source, processes):
+        tree = generator.fromFile(StringIO.StringIO(source),
+                                  processes=processes, **self.options)
+        self.assertEquals(generator.toString(tree, **self.options),
+                          self.in_order(source, processes))
+
+    def example(self):
+        with open("example.src.html", "rb") as fp:
+            return fp.read()
+
+    def test_makefile(self):
+        # As --disable=sub --enable=sub gives them
+        self.check_order(self.example(),
+                         ["filter", "toc", "xref", "annotate", "sub"])
+
+    def test_repeated(self):
+        self.check_order(self.example(),
+                         ["filter", "sub", "toc", "xref", "annotate", "sub"])
+
+    def test_repeated_visitor(self):
+        module = types.ModuleType(str("count"))
+        module.countElements = countElements
+        module.Visitor = CountingVisitor
+        registry.register(registry.Process("countElements", module))
+        try:
+            self.check_order(b"<!doctype html><p>",
+                             ["countElements", "countElements"])
+        finally:
+            del registry.processes["countElements"]
+
+    def test_substitution_last(self):
+        self.check_order(b"<!doctype html><title>Foo</title><h1>[TITLE]</h1>"
+                         b"<!--toc--><h2>[YEAR]</h2><p><dfn>Foo</dfn> "
+                         b"<span>[TITLE]</span> <span>Foo</span>",
+                         ["filter", "toc", "xref", "annotate", "sub"])
+
+    def test_filter_last(self):
+        self.check_order(b"<!doctype html><h1>A</h1><!--toc-->"
+                         b"<h2 class=dropped>[YEAR]</h2><h2>[YEAR]</h2>"
+                         b"<p><dfn>2009</dfn> <span>2009</span>",
+                         ["sub", "toc", "filter", "xref"])
+
+    def test_enable_disable(self):
+        # The Makefile's example.html
+        output = os.path.join(tempfile.mkdtemp(), "example.html")
+        try:
+            self.assertEquals(run_anolis("--disable=sub", "--enable=sub",
+                                         "--pubdate", "23 Jan 2009",
+                                         "example.src.html", output),
+                              (0, b"", b""))
+            with open(output, "rb") as fp:
+                with open("example.html", "rb") as expected:
+                    self.assertEquals(fp.read(), expected.read())
+        finally:
+            shutil.rmtree(os.path.dirname(output))
+
+
+class WalkNodesTestCase(unittest.TestCase):
+    """The walk done where lxml's iterwalk has no comment and pi events."""
+
+    @unittest.skipUnless(walker.iterwalk_nodes,
+                         "Nothing to compare with in this version of lxml")
+    def test_fallback(self):
+        tree = generator.fromFile(StringIO.StringIO(
+            b"<!--before--><!doctype html><!--a--><p>x<?pi y?><b>z<!--b-->"
+            b"</b></html><!--after-->"), processes=[])
+        native = walker.iterwalk_nodes
+        for events in (("start", "end", "comment", "pi"), ("comment", ),
+                       ("start", "pi"), ("end", )):
+            expected = list(etree.iterwalk(tree, events=events))
+            walker.iterwalk_nodes = False
             try:
-                output = StringIO.StringIO()
+                self.assertEquals(list(walker.walkNodes(tree, events)),
+                                  expected)
+            finally:
+                walker.iterwalk_nodes = native
+
+
+class XrefDatabaseTestCase(unittest.TestCase):
+    """The golden tests that use tests/xref, run against a compiled copy of
+    it, and how the copy gets compiled again, or not used, as it changes."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.xref = os.path.join(self.directory, "xref")
+        shutil.copytree(os.path.join("tests", "xref"), self.xref)
+        xrefdb.compileDatabase(self.xref)
+        self.database = xrefdb.databasePath(self.xref)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def touch(self, path):
+        # Later than the database, however coarse the file system's mtimes
+        mtime = os.stat(self.database).st_mtime + 10
+        os.utime(path, (mtime, mtime))
+
+    def write_json(self, path, data):
+        with open(path, "w") as fp:
+            json.dump(data, fp)
+        self.touch(path)
 
-                # Get the input
-                input = open(file_name, "rb")
+    def check_golden_tests(self):
+        file_names = [file_name
+                      for file_name in get_files("tests", "*.src.html")
+                      if get_options(file_name).get("xref") == "tests/xref"]
+        self.assertTrue(file_names)
+        for file_name in file_names:
+            kwargs = get_options(file_name)
+            kwargs["xref"] = self.xref
+            input = open(file_name, "rb")
+            try:
                 tree = generator.fromFile(input, **kwargs)
+            finally:
                 input.close()
+            output = StringIO.StringIO()
+            generator.toFile(tree, output, **kwargs)
+            self.assertEquals(output.getvalue(), get_expected(file_name),
+                              file_name)
 
-                # Get the output
-                generator.toFile(tree, output, **kwargs)
+    def test_golden_tests(self):
+        self.assertTrue(xrefdb.connect(self.xref) is not None)
+        self.check_golden_tests()
+        self.assertTrue(os.path.abspath(self.database) in xrefdb.databases)
 
-                # Get the expected result
-                expectedfp = open(base_path + ".html", "rb")
-                expected = expectedfp.read()
-                expectedfp.close()
+    def test_changed_definitions(self):
+        path = os.path.join(self.xref, "xrefs", "foobar.json")
+        data = xrefdb.readJSON(path)
+        data["definitions"]["new term"] = "new-term"
+        self.write_json(path, data)
+        spec = xrefdb.connect(self.xref).spec("foobar")
+        self.assertEquals(spec["values"]["new term"], "new-term")
+        self.check_golden_tests()
 
-                # Run the test
-                self.assertEquals(output.getvalue(), expected)
-            except IOError as err:
-                self.fail(err)
+    def test_changed_specs(self):
+        path = os.path.join(self.xref, "specs.json")
+        shutil.copy(os.path.join(self.xref, "xrefs", "foobar.json"),
+                    os.path.join(self.xref, "xrefs", "other.json"))
+        specs = xrefdb.readJSON(path)
+        specs["other"] = "other.json"
+        self.write_json(path, specs)
+        database = xrefdb.connect(self.xref)
+        self.assertTrue(database.spec("other") is not None)
+        self.check_golden_tests()
 
-        setattr(TestCase, "test_%s" % (file_name), testFunc)
+    def test_missing_source(self):
+        path = os.path.join(self.xref, "specs.json")
+        specs = xrefdb.readJSON(path)
+        specs["missing"] = "missing.json"
+        self.write_json(path, specs)
+        mtime = os.stat(self.database).st_mtime
+        self.assertTrue(xrefdb.connect(self.xref) is None)
+        # Left for the JSON files to be read instead
+        self.assertEquals(os.stat(self.database).st_mtime, mtime)
+        self.check_golden_tests()
+
+
+def run_anolis(*args):
+    """Run the anolis script with the given arguments, returning its exit
+    status and what it wrote to stdout and stderr."""
+    process = subprocess.Popen([sys.executable, "anolis"] + list(args),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
+
+
+class ServerTestCase(unittest.TestCase):
+    """Documents processed by an anolis --serve, sent to it with anolis
+    --connect."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket = os.path.join(self.directory, "anolis.sock")
+        self.server = subprocess.Popen([sys.executable, "anolis", "--serve",
+                                        self.socket])
+        deadline = time.time() + 30
+        while not os.path.exists(self.socket):
+            self.assertTrue(self.server.poll() is None, "Server exited")
+            self.assertTrue(time.time() < deadline, "Server didn't start")
+            time.sleep(0.05)
+
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.terminate()
+            self.server.wait()
+        shutil.rmtree(self.directory)
+
+    def process(self, file_name, *args):
+        output = os.path.join(self.directory, "output.html")
+        status, stdout, stderr = run_anolis(*(args + (file_name, output)))
+        with open(output, "rb") as fp:
+            return status, fp.read(), stderr
+
+    def connect(self, file_name):
+        return self.process(file_name, "--connect", self.socket)
+
+    def test_documents(self):
+        file_name = os.path.join("tests", "toc-basic.src.html")
+        expected = self.process(file_name)
+        self.assertEquals(expected[::2], (0, b""))
+        self.assertEquals(self.connect(file_name), expected)
+
+        failing = os.path.join(self.directory, "failing.src.html")
+        with open(failing, "wb") as fp:
+            fp.write(b"<!doctype html><p><dfn>foo</dfn> <dfn>foo</dfn>")
+        status, output, stderr = self.connect(failing)
+        self.assertEquals(status, 1)
+        self.assertEquals(stderr,
+                          b'The term "foo" is defined more than once\n')
+        self.assertEquals(output, b"")
+        self.assertEquals(self.process(failing), (status, output, stderr))
+
+        # And the server is still there for the next one
+        self.assertEquals(self.connect(file_name), expected)
+
+    def test_stopped_server(self):
+        self.server.terminate()
+        self.assertEquals(self.server.wait(), 0)
+        self.assertFalse(os.path.exists(self.socket))
+        status, output, stderr = self.connect(os.path.join("tests",
+                                                           "toc-basic.src.html"))
+        self.assertEquals(status, 1)
+        self.assertTrue(stderr.startswith(b"Could not get a response from " +
+                                          self.socket.encode("utf-8")),
+                        stderr)
+        self.assertEquals(output, b"")
+
+
+class BatchTestCase(unittest.TestCase):
+    """Documents processed with anolis --batch, failing or not."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ("toc-basic", "terms-basic"):
+            shutil.copy(os.path.join("tests", name + ".src.html"),
+                        self.directory)
+        with open(self.path("failing.src.html"), "wb") as fp:
+            fp.write(b"<!doctype html><p><dfn>foo</dfn> <dfn>foo</dfn>")
+        manifest = [
+            {"input": "toc-basic.src.html", "output": "toc-basic.html"},
+            {"input": "failing.src.html", "output": "failing.html"},
+            {"input": "terms-basic.src.html", "output": "terms-basic.html",
+             "options": {"omit_optional_tags": True,
+                         "allow_duplicate_dfns": True}},
+            {"input": "missing.src.html", "output": "missing.html"},
+        ]
+        with open(self.path("manifest.json"), "w") as fp:
+            json.dump(manifest, fp)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name), "rb") as fp:
+            return fp.read()
+
+    def check_batch(self, jobs):
+        status, stdout, stderr = run_anolis("--batch",
+                                            self.path("manifest.json"),
+                                            "--jobs", str(jobs),
+                                            "--enable", "terms")
+        self.assertEquals(status, 1)
+
+        # Each output as anolis writes it given the document on its own
+        for name, args in (("toc-basic", ()),
+                           ("terms-basic", ("--omit-optional-tags",
+                                            "--allow-duplicate-dfns"))):
+            single = name + ".single.html"
+            self.assertEquals(run_anolis("--enable", "terms",
+                                         self.path(name + ".src.html"),
+                                         self.path(single), *args),
+                              (0, b"", b""))
+            self.assertEquals(self.read(name + ".html"), self.read(single))
+        self.assertFalse(os.path.exists(self.path("failing.html")))
+        self.assertFalse(os.path.exists(self.path("missing.html")))
+
+        lines = stderr.decode("utf-8").splitlines()
+        self.assertEquals([line.split()[0] + " " + line.split()[-1]
+                           for line in lines[:4]],
+                          ["ok " + self.path("toc-basic.src.html"),
+                           "FAILED " + self.path("failing.src.html"),
+                           "ok " + self.path("terms-basic.src.html"),
+                           "FAILED " + self.path("missing.src.html")])
+        errors = "\n".join(lines[4:])
+        self.assertTrue("%s:\nThe term \"foo\" is defined more than once" %
+                        self.path("failing.src.html") in errors, errors)
+        self.assertTrue("%s:\n[Errno 2] No such file or directory" %
+                        self.path("missing.src.html") in errors, errors)
+        self.assertTrue(lines[-1].startswith("4 documents, 2 failed, in "),
+                        lines[-1])
+
+    def test_one_job(self):
+        self.check_batch(1)
+
+    def test_several_jobs(self):
+        self.check_batch(2)
+
+
+class WatchTestCase(unittest.TestCase):
+    """Documents kept up to date by anolis --watch, one poll at a time."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.xref = os.path.join(self.directory, "xref")
+        shutil.copytree(os.path.join("tests", "xref"), self.xref)
+        self.work = []
+        # The second also uses references.json
+        for name, processes in (("toc-basic", []), ("terms-basic", ["refs"])):
+            shutil.copy(os.path.join("tests", name + ".src.html"),
+                        self.directory)
+            options = get_options(os.path.join("tests", name + ".src.html"))
+            options["processes"] += processes
+            options["xref"] = self.xref
+            entry = {"input": self.path(name + ".src.html"),
+                     "output": self.path(name + ".html")}
+            self.work.append((entry, options))
+        self.log = StringIO.StringIO()
+        self.seen = watch.build(self.work, self.log)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name), "rb") as fp:
+            return fp.read()
+
+    def change(self, path, data=None):
+        # Later than when it was seen, however coarse the file system's
+        # mtimes
+        mtime = os.stat(path).st_mtime + 10
+        if data is not None:
+            with open(path, "wb") as fp:
+                fp.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def poll(self):
+        return [result["output"]
+                for result in watch.poll(self.work, self.seen, self.log)]
+
+    def test_build(self):
+        for name in ("toc-basic", "terms-basic"):
+            self.assertEquals(self.read(name + ".html"),
+                              get_expected(os.path.join("tests",
+                                                        name + ".src.html")))
+        self.assertEquals(self.poll(), [])
+
+    def test_changed_input(self):
+        self.change(self.path("toc-basic.src.html"),
+                    b"<!doctype html><h1>Foo</h1><!--toc--><h2>Qux</h2>")
+        self.assertEquals(self.poll(), [self.path("toc-basic.html")])
+        self.assertTrue(b"<h2 id=qux>" in self.read("toc-basic.html"))
+        self.assertEquals(self.poll(), [])
+
+    def test_changed_data_file(self):
+        self.change(os.path.join(self.xref, "references.json"))
+        self.assertEquals(self.poll(), [self.path("terms-basic.html")])
+        self.assertEquals(self.poll(), [])
+
+    def test_failed_rebuild(self):
+        before = self.read("toc-basic.html")
+        self.change(self.path("toc-basic.src.html"),
+                    b"<!doctype html><p><dfn>foo</dfn> <dfn>foo</dfn>")
+        self.assertEquals(self.poll(), [self.path("toc-basic.html")])
+        self.assertTrue("Failed to build %s:\nThe term \"foo\" is defined "
+                        "more than once\n" % self.path("toc-basic.html")
+                        in self.log.getvalue(), self.log.getvalue())
+        self.assertEquals(self.read("toc-basic.html"), before)
+
+
+class Messages(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def lookUpIDs(ElementTree, context=None, **kwargs):
+    context.ids.get("bar")
+
+
+def giveID(ElementTree, **kwargs):
+    ElementTree.getroot().find("body/p").set("id", "bar")
+
+
+class RegistryTestCase(unittest.TestCase):
+    """What processes declare in the registry about ids and comments."""
+
+    def setUp(self):
+        self.module = types.ModuleType(str("ids"))
+        self.module.lookUpIDs = lookUpIDs
+        self.module.giveID = giveID
+        self.names = []
+
+    def tearDown(self):
+        for name in self.names:
+            del registry.processes[name]
+
+    def register(self, name, **kwargs):
+        registry.register(registry.Process(name, self.module, **kwargs))
+        self.names.append(name)
+
+    def process(self, source, processes):
+        tree = generator.fromFile(StringIO.StringIO(source),
+                                  processes=processes)
+        return tree.getroot().find("body")
+
+    def check_ids(self, mutates_ids):
+        self.register("lookUpIDs")
+        self.register("giveID", mutates_ids=mutates_ids)
+        body = self.process(b"<!doctype html><h1>A</h1><!--toc-->"
+                            b"<h2>Bar</h2><p>",
+                            ["lookUpIDs", "giveID", "toc"])
+        return body.find("h2").get("id"), body.find("p").get("id")
+
+    def test_mutates_ids(self):
+        self.assertEquals(self.check_ids(True), ("bar-0", "bar"))
+
+    def test_keeps_ids(self):
+        # Declared wrongly, the id the process gave gets reused
+        self.assertEquals(self.check_ids(False), ("bar", "bar"))
+
+    def test_undeclared_process(self):
+        self.assertTrue(registry.Process("ids", "ids").mutates_ids is False)
+        sys.modules[str("ids")] = self.module
+        try:
+            process = registry.get("ids")
+        finally:
+            del sys.modules[str("ids")]
+        self.names.append("ids")
+        self.assertTrue(process.mutates_ids)
+
+    def test_unreplaced_comments(self):
+        messages = Messages()
+        logging.getLogger("anolis").addHandler(messages)
+        try:
+            self.process(b"<!doctype html><h1>A</h1><!-- note -->"
+                         b"<!--begin-tco--><p>x<!--end-tco-->"
+                         b"<!--begin-toc--><!--end-toc-->"
+                         b"<!--begin-link-->http://example.com<!--end-link-->",
+                         ["sub", "toc"])
+            self.assertEquals(messages.messages,
+                              ["No process replaces <!--begin-tco-->"])
+
+            # Nor, declared by a process, by any process run
+            del messages.messages[:]
+            self.register("tco", function="lookUpIDs", comments=["tco"])
+            self.process(b"<!doctype html><!--begin-tco--><!--end-tco-->",
+                         ["sub"])
+            self.assertEquals(messages.messages, [])
+        finally:
+            logging.getLogger("anolis").removeHandler(messages)
+
+
+def run_tests(jobs, repeat, scale=1):
+    """Run every test, and at every scale, across a pool of the given
+    number of worker processes, largest first, with the processes they use
+    imported before the workers get forked."""
+    work = [(file_name, test_scale, repeat)
+            for test_scale in sorted(set([scale, 1]), reverse=True)
+            for file_name in get_files("tests", "*.src.html")]
+    batch.warmUp(set(process for file_name, test_scale, repeat in work
+                     for process in get_options(file_name)["processes"]))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for job, result in zip(work, pool.map(run_test, work, chunksize=1)):
+            results[job[:2]] = result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def report_slowest(count, output):
+    timed = sorted(((result["seconds"], file_name, scale)
+                    for (file_name, scale), result in results.items()
+                    if result["seconds"] is not None), reverse=True)
+    if not timed or not count:
+        return
+    output.write("\nSlowest tests:\n")
+    for seconds, file_name, scale in timed[:count]:
+        output.write("%8.3fs  %s%s\n" % (seconds, file_name,
+                                          " (x%i)" % scale if scale > 1
+                                          else ""))
 
 
 def main():
-    buildTestSuite()
-    unittest.main()
+    parser = argparse.ArgumentParser(description=__doc__, add_help=False)
+    parser.add_argument("--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Worker processes to run the tests with. "
+                             "Default: one per CPU")
+    parser.add_argument("--slowest", type=int, default=5,
+                        help="How many of the slowest tests to list. "
+                             "Default: 5")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="Also run each test with its content repeated "
+                             "this many times, to check it scales linearly")
+    parser.add_argument("--max-order", type=float, default=1.5,
+                        help="Power of the size that the time taken by a "
+                             "test run with --scale may grow with. "
+                             "Default: 1.5")
+    args, argv = parser.parse_known_args()
+
+    # Time the tests when checking how they scale at their fastest, so not
+    # just as they get imported
+    repeat = 3 if args.scale > 1 else 1
+    buildTestSuite(args.scale, repeat, args.max_order)
+    if args.jobs > 1:
+        run_tests(args.jobs, repeat, args.scale)
+    program = unittest.main(argv=sys.argv[:1] + argv, exit=False)
+    report_slowest(args.slowest, sys.stderr)
+    sys.exit(not program.result.wasSuccessful())
 
 if __name__ == "__main__":
     main()